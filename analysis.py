@@ -0,0 +1,337 @@
+# pupil light reflex analysis of recorded sessions
+
+from concurrent.futures import ProcessPoolExecutor
+import csv
+import hashlib
+import json
+import numpy as np
+import os
+import sys
+
+from blink import cleanPupil
+from sessionindex import SessionIndex, indexPath
+from sessionwriter import BINARY_MAGIC, CSV_COLUMNS, CSV_HEADER, MANIFEST_EXTENSION, ChunkedSession, readBinary
+
+CACHE_FILE = ".analysis_cache.json"
+SUMMARY_FILE = "analysis.csv"
+CACHE_VERSION = 3 # change this when the metrics change, to ignore old results
+
+BASELINE_SECONDS = 1.0 # before each light change
+RESPONSE_SECONDS = 5.0 # after each light change
+SMOOTH_SECONDS = 0.1
+CONSTRICTION_SPEED = 1.0 # mm/s, faster than this counts as constricting
+MIN_EVENT_GAP = 2.0 # seconds between detected light changes
+REDILATION_FRACTION = 0.75 # redilation time is until this much of the constriction has recovered
+BLOCK_SECONDS = 300.0 # sessions are analysed this much at a time, so any length takes the same memory
+BLOCK_MARGIN = RESPONSE_SECONDS + 2.0 # read either side of each block, so its edges come out the same as the middle
+
+EVENT_FIELDS = ['event', 'time', 'latency', 'difference_baseline', 'difference_peak', 'amplitude_asymmetry']
+EYE_FIELDS = ['baseline', 'minimum', 'amplitude', 'latency', 'peak_velocity', 'redilation_time']
+
+def isSession(path):
+    # true for files written by EyeData, whatever their name, and the manifests of chunked sessions
+    if path.endswith(MANIFEST_EXTENSION):
+        return os.path.isfile(path)
+
+    try:
+        with open(path, 'rb') as infile:
+            start = infile.read(max(len(CSV_HEADER), len(BINARY_MAGIC)))
+    except OSError:
+        return False
+
+    return start.startswith(BINARY_MAGIC) or start.startswith(CSV_HEADER.encode())
+
+def loadSession(path):
+    # returns a dict of column name -> array
+    if path.endswith(MANIFEST_EXTENSION):
+        return sessionColumns(ChunkedSession(path)[:])
+
+    with open(path, 'rb') as infile:
+        binary = infile.read(len(BINARY_MAGIC)) == BINARY_MAGIC
+
+    if binary:
+        return sessionColumns(readBinary(path))
+
+    # event lines start with '#', so loadtxt skips them
+    data = np.loadtxt(path, delimiter=',', skiprows=1, usecols=range(1, len(CSV_COLUMNS) + 1), ndmin=2)
+    return {name: data[:, i] for i, name in enumerate(CSV_COLUMNS)}
+
+def loadSegment(path, start, end=None, index=None):
+    # Like loadSession, but only the samples from start to end (elapsed
+    # seconds, None for the end of the session). The session index says where
+    # they are in the file, so only that part is read, however long the
+    # recording. e.g. every target:
+    #   index = SessionIndex(path)
+    #   for event, start, end in index.segments("target"):
+    #       data = loadSegment(path, start, end, index)
+    if index is None:
+        index = SessionIndex(path)
+
+    span = index.span(start, end)
+    if span is None:
+        data = loadSession(path) # nothing indexed yet
+    else:
+        firstSample, endSample, firstOffset, endOffset = span
+        with open(path, 'rb') as infile:
+            binary = infile.read(len(BINARY_MAGIC)) == BINARY_MAGIC
+
+            if binary:
+                samples = readBinary(path)[firstSample:endSample]
+                data = {name: np.asarray(samples[name], dtype=float) for name in CSV_COLUMNS}
+            else:
+                infile.seek(firstOffset)
+                text = infile.read(-1 if endOffset is None else endOffset - firstOffset)
+                rows = np.loadtxt(text.decode().splitlines(), delimiter=',', usecols=range(1, len(CSV_COLUMNS) + 1), ndmin=2)
+                data = {name: rows[:, i] for i, name in enumerate(CSV_COLUMNS)}
+
+    t = data['elapsed']
+    keep = (t >= start) & ((t < end) if end is not None else True)
+    return {name: values[keep] for name, values in data.items()}
+
+def sessionColumns(samples):
+    # samples from readBinary or ChunkedSession -> dict of column name -> array, like loadSession
+    return {name: np.asarray(samples[name], dtype=float) for name in CSV_COLUMNS}
+
+def lightEvents(session):
+    # when the light went on (elapsed seconds), as noted during the ChunkedSession, or None if it wasn't
+    times = [event.elapsed for event in session.events("light", "on") if event.elapsed is not None]
+    return (np.array(times) if len(times) > 0 else None)
+
+def smooth(values, samples):
+    # centred moving average, NaN wherever the window includes a gap
+    if samples < 2:
+        return values
+
+    kernel = np.ones(samples) / samples
+    padded = np.pad(values, (samples // 2, samples - 1 - samples // 2), mode='edge')
+    return np.convolve(padded, kernel, mode='valid')
+
+def detectLightChanges(t, diameter, velocity, start=-np.inf, end=np.inf, previous=None):
+    # start of each run of fast constriction, at least MIN_EVENT_GAP apart.
+    # Only those from start to end, and after previous (the last light change
+    # before start), when going through a session a block at a time.
+    constricting = velocity < -CONSTRICTION_SPEED
+    starts = np.flatnonzero(constricting[1:] & ~constricting[:-1]) + 1
+
+    events = []
+    last = previous
+    for i in starts:
+        if start <= t[i] < end and (last is None or t[i] - last >= MIN_EVENT_GAP):
+            events.append(t[i])
+            last = t[i]
+    return np.array(events)
+
+def eyeMetrics(t, diameter, velocity, stimulus, stimulusKnown):
+    metrics = dict.fromkeys(EYE_FIELDS, np.nan)
+
+    base = (t >= stimulus - BASELINE_SECONDS) & (t < stimulus)
+    window = np.flatnonzero((t >= stimulus) & (t < stimulus + RESPONSE_SECONDS))
+    if not base.any() or len(window) < 2 or np.isnan(diameter[base]).all() or np.isnan(diameter[window]).all():
+        return metrics
+
+    baseline = np.nanmean(diameter[base])
+    lowest = window[np.nanargmin(diameter[window])]
+    amplitude = baseline - diameter[lowest]
+    metrics['baseline'] = baseline
+    metrics['minimum'] = diameter[lowest]
+    metrics['amplitude'] = amplitude
+    metrics['peak_velocity'] = -np.nanmin(velocity[window[0]:lowest + 1])
+
+    # latency is only meaningful if we know when the light changed
+    if stimulusKnown:
+        onset = np.flatnonzero(velocity[window[0]:lowest + 1] < -CONSTRICTION_SPEED)
+        if len(onset) > 0:
+            metrics['latency'] = t[window[0] + onset[0]] - stimulus
+
+    # time from the smallest pupil until it has mostly recovered
+    if amplitude > 0:
+        after = window[window >= lowest]
+        recovered = np.flatnonzero(diameter[after] >= diameter[lowest] + REDILATION_FRACTION * amplitude)
+        if len(recovered) > 0:
+            metrics['redilation_time'] = t[after[recovered[0]]] - t[lowest]
+
+    return metrics
+
+def analyseSession(path, stimuli=None):
+    # metrics for each light change in a session, as a list of dicts. If the
+    # times of the light changes (elapsed seconds) aren't given, they come from
+    # the light events in the session. If there aren't any they are detected
+    # from the start of each constriction, and latency is unknown.
+    # The session is read BLOCK_SECONDS at a time (see ChunkedSession).
+    session = ChunkedSession(path)
+    timeRange = session.timeRange()
+    if len(session) < 2 or timeRange is None:
+        return []
+
+    if stimuli is None:
+        stimuli = lightEvents(session)
+    stimulusKnown = stimuli is not None
+    if stimulusKnown:
+        stimuli = np.asarray(stimuli, dtype=float)
+
+    events = []
+    previous = None # the last light change detected
+    first, last = timeRange
+    blockStart = first
+    while blockStart <= last:
+        blockEnd = blockStart + BLOCK_SECONDS
+        data = sessionColumns(session.between(blockStart - BLOCK_MARGIN, blockEnd + BLOCK_MARGIN))
+        t = data['elapsed']
+        if len(t) >= 2:
+            eyes = pupilTraces(data)
+
+            # light changes before the first sample or after the last go in the first or last block
+            start = (-np.inf if blockStart == first else blockStart)
+            end = (np.inf if blockEnd > last else blockEnd)
+            if stimulusKnown:
+                blockStimuli = stimuli[(stimuli >= start) & (stimuli < end)]
+            else:
+                # both eyes react to light, so use their average
+                mean = (eyes['right'][0] + eyes['left'][0]) / 2
+                blockStimuli = detectLightChanges(t, mean, np.gradient(mean, t), start, end, previous)
+                if len(blockStimuli) > 0:
+                    previous = blockStimuli[-1]
+
+            for stimulus in blockStimuli:
+                events.append(stimulusMetrics(len(events) + 1, stimulus, data, eyes, stimulusKnown))
+
+        blockStart = blockEnd
+
+    return events
+
+def pupilTraces(data):
+    # {'right', 'left'} -> (diameter, velocity), with blinks filled in and
+    # longer gaps left as NaN so they are ignored
+    t = data['elapsed']
+    rate = 1.0 / np.median(np.diff(t))
+    smoothSamples = max(1, int(round(SMOOTH_SECONDS * rate)))
+
+    eyes = {}
+    for eye, diam, valid in (('right', 'rpmm', 'rpmmv'), ('left', 'lpmm', 'lpmmv')):
+        diameter = smooth(cleanPupil(t, data[diam], data[valid], rate)[0], smoothSamples)
+        eyes[eye] = (diameter, np.gradient(diameter, t))
+    return eyes
+
+def stimulusMetrics(n, stimulus, data, eyes, stimulusKnown):
+    # the metrics for light change number n
+    t = data['elapsed']
+    bothValid = data['rpmmv'].astype(bool) & data['lpmmv'].astype(bool)
+    event = dict.fromkeys(EVENT_FIELDS, np.nan)
+    event['event'] = n
+    event['time'] = stimulus
+
+    for eye, (diameter, velocity) in eyes.items():
+        for name, value in eyeMetrics(t, diameter, velocity, stimulus, stimulusKnown).items():
+            event[eye + '_' + name] = value
+
+    latencies = [event['right_latency'], event['left_latency']]
+    if not np.isnan(latencies).all():
+        event['latency'] = np.nanmean(latencies)
+
+    # the Difference column is only meaningful when both pupils are valid
+    base = bothValid & (t >= stimulus - BASELINE_SECONDS) & (t < stimulus)
+    if base.any():
+        event['difference_baseline'] = data['delta'][base].mean()
+    peak = bothValid & (t >= stimulus) & (t < stimulus + RESPONSE_SECONDS)
+    if peak.any():
+        event['difference_peak'] = data['delta'][peak].max()
+
+    amplitudes = (event['right_amplitude'], event['left_amplitude'])
+    if not np.isnan(amplitudes).any() and sum(amplitudes) != 0:
+        event['amplitude_asymmetry'] = (amplitudes[0] - amplitudes[1]) / (sum(amplitudes) / 2)
+
+    return {key: (value if key == 'event' else float(value)) for key, value in event.items()}
+
+def sessionFiles(path):
+    # the session file and its index, or a chunked session's manifest and every chunk and index
+    files = [path]
+    if path.endswith(MANIFEST_EXTENSION):
+        files += ChunkedSession(path).paths
+    return [filepath for path in files for filepath in (path, indexPath(path)) if os.path.exists(filepath)]
+
+def fileHash(path):
+    # includes the session index, as that's where a binary session's events are
+    digest = hashlib.sha256()
+    for filepath in sessionFiles(path):
+        with open(filepath, 'rb') as infile:
+            for block in iter(lambda: infile.read(1 << 20), b''):
+                digest.update(block)
+    return digest.hexdigest()
+
+def loadCache(path):
+    try:
+        with open(path) as infile:
+            cache = json.load(infile)
+    except (OSError, ValueError):
+        return {}
+
+    return (cache.get("results", {}) if cache.get("version") == CACHE_VERSION else {})
+
+def saveCache(path, results):
+    with open(path, 'w') as outfile:
+        json.dump({"version": CACHE_VERSION, "results": results}, outfile)
+
+def analyseDirectory(resultsdir, workers=None):
+    # analyses every session in the directory, in parallel, reusing cached
+    # results for any file that hasn't changed. Returns {filename: events}.
+    paths = sorted(os.path.join(resultsdir, name) for name in os.listdir(resultsdir))
+    paths = [path for path in paths if os.path.isfile(path) and isSession(path)]
+
+    # the chunks of a chunked session are analysed together, through its manifest
+    chunks = set()
+    for path in paths:
+        if path.endswith(MANIFEST_EXTENSION):
+            chunks.update(ChunkedSession(path).paths)
+    paths = [path for path in paths if path not in chunks]
+
+    cachePath = os.path.join(resultsdir, CACHE_FILE)
+    cache = loadCache(cachePath)
+
+    hashes = {path: fileHash(path) for path in paths}
+    todo = [path for path in paths if hashes[path] not in cache]
+    if len(todo) > 0:
+        print("Analysing", len(todo), "new session(s),", len(paths) - len(todo), "cached")
+        with ProcessPoolExecutor(workers) as pool:
+            for path, events in zip(todo, pool.map(analyseSession, todo)):
+                cache[hashes[path]] = events
+
+    # only keep results for files that are still here
+    cache = {hashes[path]: cache[hashes[path]] for path in paths}
+    saveCache(cachePath, cache)
+
+    return {os.path.split(path)[1]: cache[hashes[path]] for path in paths}
+
+def writeSummary(results, outpath):
+    # one row per light change per session
+    fields = ['session'] + EVENT_FIELDS + [eye + '_' + name for eye in ('right', 'left') for name in EYE_FIELDS]
+    with open(outpath, 'w', newline='') as outfile:
+        writer = csv.DictWriter(outfile, fields)
+        writer.writeheader()
+        for session, events in results.items():
+            for event in events:
+                writer.writerow(dict(event, session=session))
+
+if __name__ == '__main__':
+    def printUsage():
+        print("Usage:", os.path.split(__file__)[1], "<results_dir | session_file>")
+        print("      ", "pupil light reflex metrics for each light change, written to " + SUMMARY_FILE)
+
+    if len(sys.argv) < 2:
+        printUsage()
+        sys.exit(1)
+
+    target = sys.argv[1]
+    if os.path.isdir(target):
+        results = analyseDirectory(target)
+        outpath = os.path.join(target, SUMMARY_FILE)
+    elif os.path.isfile(target):
+        results = {os.path.split(target)[1]: analyseSession(target)}
+        outpath = os.path.splitext(target)[0] + "_" + SUMMARY_FILE
+    else:
+        print("ERROR: no such file or directory:", target, file=sys.stderr)
+        sys.exit(1)
+
+    writeSummary(results, outpath)
+    print(sum(len(events) for events in results.values()), "light changes in", len(results), "session(s), written to:", outpath)
+
+# EOF
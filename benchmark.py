@@ -0,0 +1,315 @@
+# benchmarks for the acquisition and display pipeline, runs headless
+
+import argparse
+from datetime import datetime
+import json
+import numpy as np
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from eyedata import EyeData
+from gazepoint import CHANNELS, DEFAULT_CHANNELS, RECORD_END, RECORD_FORMAT
+from gazerecords import RecordReader
+from sessionwriter import BINARY_EXTENSION, SessionWriter, openSink
+
+def makeRecords(count, rate=150, start=0.0, channels=()):
+    # plausible records with a few invalid samples, as one block of bytes,
+    # with the attributes of any other channels on the end
+    extra = "".join(' {}="{:.5f}"'.format(name, 0.25) for channel in channels for name, kind in CHANNELS[channel]
+                    if channel not in DEFAULT_CHANNELS)
+    records = []
+    for i in range(count):
+        valid = (i % 97) != 0
+        records.append(RECORD_FORMAT.format(start + i / rate, 0.5, 0.5, True, 0.45, 0.55, True,
+                                            (4.0 + (i % 50) / 100 if valid else 0.0), valid, 4.5, True))
+    return "".join(records).replace(RECORD_END.decode(), extra + RECORD_END.decode()).encode()
+
+def percentiles(values):
+    values = np.asarray(values, dtype=float)
+    if len(values) == 0:
+        return None
+
+    return {"count": len(values),
+            "mean": float(values.mean()),
+            "p50": float(np.percentile(values, 50)),
+            "p95": float(np.percentile(values, 95)),
+            "p99": float(np.percentile(values, 99)),
+            "max": float(values.max())}
+
+def fakeTracker(send):
+    # listens on a free local port and calls send(conn) for the first
+    # connection, then hangs up cleanly. Returns the address to connect to.
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(('127.0.0.1', 0))
+    server.listen()
+
+    def serve():
+        conn, addr = server.accept()
+        server.close()
+        with conn:
+            send(conn)
+            conn.shutdown(socket.SHUT_WR)
+
+            # read until the client hangs up too, so it never sees a reset
+            while conn.recv(4096):
+                pass
+
+    threading.Thread(target=serve, daemon=True).start()
+    return server.getsockname()
+
+def benchParser(count, channels=()):
+    # bytes -> records -> sample store, with no socket or file in the way
+    data = makeRecords(count, channels=channels)
+    eyedata = EyeData(os.devnull, 150, channels=channels)
+    eyedata.writer = SessionWriter(None) # never started, so nothing is written
+    reader = RecordReader(eyedata.schema)
+    chunk = 4096
+
+    start = time.perf_counter()
+    for i in range(0, len(data), chunk):
+        records = reader.feed(data[i:i + chunk])
+        if len(records) > 0:
+            eyedata.handleRecords(records)
+    seconds = time.perf_counter() - start
+
+    return {"records": reader.recordsParsed,
+            "dropped": reader.recordsDropped,
+            "seconds": seconds,
+            "records_per_second": reader.recordsParsed / seconds}
+
+def benchSocket(count):
+    # the whole receive path, from a fake tracker on a local socket
+    data = makeRecords(count)
+    address = fakeTracker(lambda conn: conn.sendall(data))
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        eyedata = EyeData(os.path.join(tmpdir, "session.csv"), 150)
+        eyedata.ADDRESS = address
+
+        start = time.perf_counter()
+        eyedata.run() # returns once the fake tracker hangs up
+        seconds = time.perf_counter() - start
+
+    return {"records": eyedata.samples.count,
+            "dropped": eyedata.reader.recordsDropped,
+            "seconds": seconds,
+            "records_per_second": eyedata.samples.count / seconds}
+
+def benchWriter(count, extension):
+    eyedata = EyeData(os.devnull, 150)
+    eyedata.writer = SessionWriter(None)
+    eyedata.handleRecords(RecordReader().feed(makeRecords(count)))
+    batches = [eyedata.samples.window(i, i + 64).copy() for i in range(0, eyedata.samples.count, 64)]
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, "session" + extension)
+        writer = SessionWriter(openSink(path))
+
+        start = time.perf_counter()
+        writer.start()
+        for batch in batches:
+            writer.write(batch)
+        writer.stop()
+        seconds = time.perf_counter() - start
+        size = os.path.getsize(path)
+
+    return {"samples": writer.samplesWritten,
+            "bytes": size,
+            "seconds": seconds,
+            "samples_per_second": writer.samplesWritten / seconds,
+            "megabytes_per_second": size / seconds / 1e6,
+            "latency_seconds": writer.latency.snapshot()}
+
+def benchGraph(frames):
+    import matplotlib
+    matplotlib.use('Agg')
+    from livegraph import LiveGraph
+
+    eyedata = EyeData(os.devnull, 150)
+    eyedata.writer = SessionWriter(None)
+    graph = LiveGraph(eyedata.samples, sampleRate=150)
+    graph.setup()
+    graph.fig.canvas.draw()
+
+    drawTimes = []
+    reader = RecordReader()
+    for i in range(frames):
+        # about a frame's worth of samples at 150 Hz and 20 fps
+        eyedata.handleRecords(reader.feed(makeRecords(8, start=i * 8 / 150)))
+        if graph.step():
+            drawTimes.append(graph.drawTime)
+
+    return {"frames": len(drawTimes),
+            "draw_seconds": percentiles(drawTimes),
+            "max_fps": 1.0 / np.mean(drawTimes)}
+
+def benchPhoto(count):
+    try:
+        from webcam import PupilWebcam
+    except ImportError as e:
+        return {"skipped": str(e)}
+
+    frame = np.random.randint(0, 256, (PupilWebcam.IDEAL_CAMERA_RES[1], PupilWebcam.IDEAL_CAMERA_RES[0], 3), dtype=np.uint8)
+    results = {}
+    for photoFormat in PupilWebcam.PHOTO_FORMATS:
+        encodeTimes = []
+        webcam = PupilWebcam(photoFormat=photoFormat, onPhotoSaved=lambda path, captured, seconds: encodeTimes.append(seconds))
+        webcam.frame = frame
+        webcam.frame_time = time.monotonic()
+
+        # how long the caller is held up, then how long the save takes
+        latencies = []
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for i in range(count):
+                start = time.perf_counter()
+                webcam.takePhoto(os.path.join(tmpdir, str(i)))
+                latencies.append(time.perf_counter() - start)
+                webcam.waitForPhotos()
+
+        results[photoFormat] = {"photos": count,
+                                "capture_seconds": percentiles(latencies),
+                                "encode_seconds": percentiles(encodeTimes)}
+
+    return results
+
+def benchLatency(seconds, rate):
+    # Time from a record being sent by the fake tracker to it being drawn on
+    # the graph. The tracker puts its send time in the TIME field.
+    import matplotlib
+    matplotlib.use('Agg')
+    from livegraph import LiveGraph
+
+    def send(conn):
+        start = time.perf_counter()
+        for i in range(int(seconds * rate)):
+            wait = start + i / rate - time.perf_counter()
+            if wait > 0:
+                time.sleep(wait)
+            conn.sendall(RECORD_FORMAT.format(time.perf_counter(), 0.5, 0.5, True, 0.5, 0.5, True, 4.0, True, 4.2, True).encode())
+
+    address = fakeTracker(send)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        eyedata = EyeData(os.path.join(tmpdir, "session.csv"), rate)
+        eyedata.ADDRESS = address
+        dataThread = threading.Thread(target=eyedata.run)
+        dataThread.start()
+
+        graph = LiveGraph(eyedata.samples, sampleRate=150)
+        graph.setup()
+        graph.fig.canvas.draw()
+
+        latencies = []
+        period = 1.0 / graph.refreshRate
+        running = True
+        while running:
+            # one last frame after the tracker hangs up, to draw the stragglers
+            running = dataThread.is_alive()
+
+            seq = graph.seq
+            if graph.step():
+                drawn = time.perf_counter()
+                samples = eyedata.samples.window(seq, graph.seq)
+                latencies.extend(drawn - (samples['elapsed'] + eyedata.timebase[0] - eyedata.timebase[1]))
+            time.sleep(period)
+
+        dataThread.join()
+
+    return {"records": eyedata.samples.count,
+            "graph_fps": graph.refreshRate,
+            "latency_seconds": percentiles(latencies)}
+
+# the GUI modules, and numpy, that only some commands should need
+HEAVY_MODULES = ['cv2', 'matplotlib', 'pynput', 'tkinter', 'numpy']
+
+def benchStartup(runs):
+    # How long each of pupil.py's commands takes to import what it needs, in
+    # a fresh interpreter each time, and which heavy modules that pulls in.
+    # "python" is an empty interpreter, for comparison.
+    from pupil import COMMANDS
+    basedir = os.path.split(os.path.abspath(__file__))[0]
+    modules = {"python": None, "pupil.py": "pupil"}
+    modules.update({command: module for command, (module, description) in COMMANDS.items()})
+
+    results = {}
+    for name, module in modules.items():
+        code = ("import sys, time\n"
+                "start = time.perf_counter()\n" +
+                ("" if module is None else "import " + module + "\n") +
+                "print(time.perf_counter() - start)\n"
+                "print(','.join(name for name in " + repr(HEAVY_MODULES) + " if name in sys.modules))\n")
+
+        importTimes, totalTimes = [], []
+        heavy = None
+        for i in range(runs):
+            start = time.perf_counter()
+            try:
+                output = subprocess.check_output([sys.executable, "-c", code], cwd=basedir, stderr=subprocess.DEVNULL).decode().split("\n")
+            except subprocess.CalledProcessError:
+                break # a module that isn't installed here
+            totalTimes.append(time.perf_counter() - start)
+            importTimes.append(float(output[0]))
+            heavy = [name for name in output[1].split(",") if name != ""]
+
+        results[name] = {"import_seconds": percentiles(importTimes),
+                         "total_seconds": percentiles(totalTimes),
+                         "heavy_modules": heavy}
+    return results
+
+def gitCommit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=os.path.split(os.path.abspath(__file__))[0],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+BENCHMARKS = {
+    "parser": lambda quick: benchParser(20000 if quick else 200000),
+    "parser_all_channels": lambda quick: benchParser(20000 if quick else 200000, list(CHANNELS)),
+    "socket": lambda quick: benchSocket(20000 if quick else 200000),
+    "writer_csv": lambda quick: benchWriter(20000 if quick else 200000, ".csv"),
+    "writer_binary": lambda quick: benchWriter(20000 if quick else 200000, BINARY_EXTENSION),
+    "graph": lambda quick: benchGraph(50 if quick else 500),
+    "photo": lambda quick: benchPhoto(3 if quick else 20),
+    "latency": lambda quick: benchLatency(2 if quick else 10, 150),
+    "startup": lambda quick: benchStartup(3 if quick else 15),
+}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the acquisition and display pipeline")
+    parser.add_argument("--output", help="write the JSON results to this file instead of stdout")
+    parser.add_argument("--only", help="comma separated benchmarks to run: " + ",".join(BENCHMARKS))
+    parser.add_argument("--quick", action="store_true", help="smaller runs, for a quick check")
+    args = parser.parse_args()
+
+    names = (args.only.split(",") if args.only else list(BENCHMARKS))
+    for name in names:
+        if name not in BENCHMARKS:
+            print("ERROR: unknown benchmark:", name, file=sys.stderr)
+            sys.exit(1)
+
+    results = {"commit": gitCommit(),
+               "timestamp": datetime.now().isoformat(),
+               "python": platform.python_version(),
+               "platform": platform.platform(),
+               "quick": args.quick,
+               "results": {}}
+
+    for name in names:
+        print("Running", name, "benchmark...", file=sys.stderr)
+        results["results"][name] = BENCHMARKS[name](args.quick)
+
+    output = json.dumps(results, indent=2)
+    if args.output is None:
+        print(output)
+    else:
+        with open(args.output, 'w') as outfile:
+            print(output, file=outfile)
+
+# EOF
@@ -0,0 +1,156 @@
+# blink and artifact removal for pupil size data
+
+from collections import deque
+import numpy as np
+
+# what counts as a bad sample
+PUPIL_MIN_SIZE_MM = 1.0
+PUPIL_MAX_SIZE_MM = 10.0
+MAX_DILATION_SPEED = 10.0 # mm/s, pupils can't really change faster than this
+
+PAD_SECONDS = 0.05 # also throw away this much either side of a bad sample
+MAX_GAP_SECONDS = 0.5 # fill in gaps up to this long, leave longer ones empty
+
+# what happened to each sample
+VALID = 0
+INTERPOLATED = 1
+MISSING = 2 # part of a long gap, the value is NaN
+
+def badSamples(t, diameter, valid):
+    # invalid according to the tracker, out of range, or changing impossibly fast
+    valid = np.asarray(valid, dtype=bool)
+    bad = ~valid | (diameter < PUPIL_MIN_SIZE_MM) | (diameter > PUPIL_MAX_SIZE_MM)
+
+    speed = np.abs(np.diff(diameter)) / np.maximum(np.diff(t), 1e-9)
+    bad[1:] |= valid[:-1] & valid[1:] & (speed > MAX_DILATION_SPEED)
+    return bad
+
+def cleanPupil(t, diameter, valid, rate):
+    # Batch version, for a whole recording. Returns (diameter, flags) where
+    # short gaps are linearly interpolated and long ones are NaN.
+    t = np.asarray(t, dtype=float)
+    diameter = np.asarray(diameter, dtype=float)
+    pad = int(round(PAD_SECONDS * rate))
+
+    # widen each bad sample by pad samples either side
+    bad = badSamples(t, diameter, valid)
+    counts = np.concatenate(([0], np.cumsum(bad)))
+    lo = np.clip(np.arange(len(t)) - pad, 0, len(t))
+    hi = np.clip(np.arange(len(t)) + pad + 1, 0, len(t))
+    masked = (counts[hi] - counts[lo]) > 0
+
+    out = diameter.copy()
+    flags = np.full(len(t), VALID, dtype=np.uint8)
+    if not masked.any():
+        return out, flags
+
+    good = np.flatnonzero(~masked)
+    if len(good) == 0:
+        return np.full_like(out, np.nan), np.full(len(t), MISSING, dtype=np.uint8)
+
+    # each run of masked samples, and the good samples either side of it
+    edges = np.diff(np.concatenate(([0], masked.astype(np.int8), [0])))
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1) # one past the end
+    before = np.where(starts > 0, starts - 1, -1)
+    after = np.where(ends < len(t), ends, -1)
+
+    short = (before >= 0) & (after >= 0)
+    short[short] = (t[after[short]] - t[before[short]]) <= MAX_GAP_SECONDS
+
+    run = np.cumsum(edges[:-1] == 1) - 1 # which run each masked sample is in
+    shortSample = masked & short[np.maximum(run, 0)]
+
+    out[masked] = np.nan
+    flags[masked] = MISSING
+    out[shortSample] = np.interp(t[shortSample], t[good], diameter[good])
+    flags[shortSample] = INTERPOLATED
+    return out, flags
+
+class BlinkFilter:
+    # Streaming version, one eye, O(1) per sample. Uses the same rules as
+    # cleanPupil, so it has to see PAD_SECONDS of samples after each one
+    # before it knows whether that sample is good: output lags input by that
+    # much (plus the length of any short gap being filled in).
+
+    def __init__(self, rate):
+        self.pad = int(round(PAD_SECONDS * rate))
+        self.waiting = deque() # (t, diameter) not yet known to be good or bad
+        self.gap = [] # times of the masked samples since the last good one
+        self.gapLong = False
+        self.lastGood = None # (t, diameter)
+        self.bads = deque() # positions of recent bad samples
+        self.count = 0 # samples pushed
+        self.previous = None # (t, diameter, valid) of the last sample pushed
+
+    def push(self, t, diameter, valid):
+        # returns a list of (t, diameter, flag) that are now final
+        bad = (not valid) or diameter < PUPIL_MIN_SIZE_MM or diameter > PUPIL_MAX_SIZE_MM
+        if valid and self.previous is not None and self.previous[2]:
+            speed = abs(diameter - self.previous[1]) / max(t - self.previous[0], 1e-9)
+            bad = bad or speed > MAX_DILATION_SPEED
+        self.previous = (t, diameter, valid)
+
+        if bad:
+            self.bads.append(self.count)
+        self.waiting.append((t, diameter))
+        self.count += 1
+
+        out = []
+        while len(self.waiting) > self.pad:
+            self.settle(self.count - len(self.waiting), out)
+        return out
+
+    def flush(self):
+        # settle everything that's waiting, e.g. at the end of a recording
+        out = []
+        while len(self.waiting) > 0:
+            self.settle(self.count - len(self.waiting), out)
+        self.finishGap(None, out)
+        return out
+
+    def settle(self, i, out):
+        # sample i has seen pad samples after it, so we know if it's masked
+        t, diameter = self.waiting.popleft()
+        while len(self.bads) > 0 and self.bads[0] < i - self.pad:
+            self.bads.popleft()
+        masked = len(self.bads) > 0 and self.bads[0] <= i + self.pad
+
+        if masked:
+            self.gap.append(t)
+            if not self.gapLong and (self.lastGood is None or t - self.lastGood[0] > MAX_GAP_SECONDS):
+                # too long to fill in, no need to hang on to it
+                self.gapLong = True
+            if self.gapLong:
+                out.extend((gt, np.nan, MISSING) for gt in self.gap)
+                self.gap = []
+            return
+
+        self.finishGap((t, diameter), out)
+        out.append((t, diameter, VALID))
+        self.lastGood = (t, diameter)
+
+    def finishGap(self, nextGood, out):
+        if len(self.gap) > 0:
+            if nextGood is None or self.lastGood is None or nextGood[0] - self.lastGood[0] > MAX_GAP_SECONDS:
+                out.extend((gt, np.nan, MISSING) for gt in self.gap)
+            else:
+                # straight line from the last good sample to this one
+                (t0, d0), (t1, d1) = self.lastGood, nextGood
+                out.extend((gt, d0 + (d1 - d0) * (gt - t0) / (t1 - t0), INTERPOLATED) for gt in self.gap)
+            self.gap = []
+        self.gapLong = False
+
+    def pushBatch(self, t, diameter, valid):
+        # pushes arrays of samples, returns arrays (t, diameter, flags) of the settled ones
+        out = []
+        for sample in zip(t.tolist(), diameter.tolist(), valid.tolist()):
+            out.extend(self.push(*sample))
+
+        if len(out) == 0:
+            return np.empty(0), np.empty(0), np.empty(0, dtype=np.uint8)
+
+        t, diameter, flags = zip(*out)
+        return np.array(t), np.array(diameter), np.array(flags, dtype=np.uint8)
+
+# EOF
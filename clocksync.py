@@ -0,0 +1,103 @@
+# mapping between the Gazepoint clock, the host's monotonic clock and wall clock time
+
+import numpy as np
+import time
+
+def clockAnchor():
+    # a matching pair of time.time_ns() and time.monotonic_ns(), for turning
+    # monotonic times into wall clock times later on
+    before = time.monotonic_ns()
+    wall = time.time_ns()
+    after = time.monotonic_ns()
+    return {"wall_ns": wall, "monotonic_ns": (before + after) // 2}
+
+def wallMicroseconds(monotonicNs, anchor):
+    # time.monotonic_ns() times -> microseconds since the epoch, by the wall clock at the anchor
+    return (np.asarray(monotonicNs, dtype=np.int64) - anchor["monotonic_ns"] + anchor["wall_ns"]) // 1000
+
+class ClockSync:
+    # Online fit of host time.monotonic_ns() against Gazepoint TIME. Each batch
+    # of records gives one point: the TIME of its newest record and when we
+    # received it. Receiving is always later than the sample, by a delay that
+    # varies (USB, Gazepoint Control, the network, us), so the drift comes from
+    # a least squares fit of all the points, weighted towards recent ones, and
+    # the offset from the smallest delay seen, which is closest to the truth.
+
+    HALF_LIFE = 60.0 # seconds, points this old count half as much in the drift
+    RELAX = 1e-4 # s/s, lets the offset move later again if the clocks wander
+    MIN_SPAN = 1.0 # seconds of points needed before the drift is used
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        # e.g. after a reconnect, when Gazepoint TIME starts again from zero
+        # (trackerOrigin, hostOriginNs, slope, offset), replaced in one go so
+        # readers on other threads see a consistent fit: take it once, check
+        # it and pass it to trackerTime(). hostOriginNs is the host time of the first point.
+        self.fit = None
+        self.sums = np.zeros(5) # weighted n, x, y, xx, xy
+        self.lastX = None
+        self.points = 0
+        self.delay = 0.0 # smoothed delay above the smallest, in seconds
+
+    def add(self, trackerTime, hostNs):
+        if self.fit is None:
+            fit = (trackerTime, hostNs, 1.0, 0.0)
+            self.lastX = 0.0
+        else:
+            fit = self.fit
+
+        trackerOrigin, hostOrigin, slope, offset = fit
+        x = trackerTime - trackerOrigin
+        y = (hostNs - hostOrigin) * 1e-9
+
+        step = max(x - self.lastX, 0.0)
+        self.sums *= 0.5 ** (step / self.HALF_LIFE)
+        self.sums += (1.0, x, y, x * x, x * y)
+        self.lastX = max(x, self.lastX)
+        self.points += 1
+
+        n, sx, sy, sxx, sxy = self.sums
+        spread = n * sxx - sx * sx
+        if x >= self.MIN_SPAN and spread > 0:
+            slope = (n * sxy - sx * sy) / spread
+
+        # the smallest delay, allowed to creep up slowly
+        lowest = y - slope * x
+        if self.points == 1:
+            offset = lowest
+        else:
+            offset = min(lowest, offset + self.RELAX * step)
+            self.delay += 0.05 * ((lowest - offset) - self.delay)
+
+        self.fit = (trackerOrigin, hostOrigin, slope, offset)
+
+    def ready(self):
+        return self.fit is not None
+
+    def hostTime(self, trackerTimes):
+        # Gazepoint TIME (seconds, scalar or array) -> estimated time.monotonic_ns() when the sample was taken
+        trackerOrigin, hostOrigin, slope, offset = self.fit
+        seconds = offset + slope * (np.asarray(trackerTimes, dtype=float) - trackerOrigin)
+        return hostOrigin + np.round(seconds * 1e9).astype(np.int64)
+
+    def trackerTime(self, hostNs, fit=None):
+        # the other way: time.monotonic_ns() -> Gazepoint TIME, using fit if
+        # given (a copy of self.fit the caller has already checked)
+        trackerOrigin, hostOrigin, slope, offset = (fit if fit is not None else self.fit)
+        return trackerOrigin + ((hostNs - hostOrigin) * 1e-9 - offset) / slope
+
+    def metrics(self):
+        fit = self.fit
+        if fit is None:
+            return None
+        return {"points": self.points, "driftPpm": (fit[2] - 1.0) * 1e6, "delay": self.delay}
+
+    def stats(self):
+        fit = self.fit
+        if fit is None:
+            return "not synced"
+        return "drift {:+.1f} ppm, delay {:.2f} ms".format((fit[2] - 1.0) * 1e6, self.delay * 1000)
+
+# EOF
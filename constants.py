@@ -0,0 +1,19 @@
+# settings shared between the programs. Imports nothing heavy, so any of them can use it for free.
+
+import os
+
+BASEDIR = os.path.split(os.path.abspath(__file__))[0]
+
+GAZEPOINT_REFRESH = 60 # records per second from the Gazepoint
+INVALID_READING = 0 # pupil size written for invalid samples
+
+# range of pupil sizes on the graph, and from the fake tracker
+PUPIL_MIN_SIZE_MM = 0
+PUPIL_MAX_SIZE_MM = 10
+
+RESULTS_DIR = os.path.join(BASEDIR, "results") # sessions go here unless told otherwise
+IMAGE_OUTDIR = os.path.join(BASEDIR, "images") # photos from the webcam
+FIXATION_TARGETS = os.path.join(BASEDIR, "gaze_targets", "bear")
+VIDEO_EXTENSION = ".mp4"
+
+# EOF
@@ -0,0 +1,35 @@
+# simple message boxes that work on any platform
+
+import os
+import sys
+
+def haveDisplay():
+    # whether a window could be shown at all
+    if sys.platform in ('win32', 'darwin'):
+        return True
+    return bool(os.environ.get('DISPLAY') or os.environ.get('WAYLAND_DISPLAY'))
+
+def showMessage(title, message):
+    # shows a message and waits until it is dismissed
+    if sys.platform == 'win32':
+        import ctypes
+        ctypes.windll.user32.MessageBoxW(0, message, title, 0)
+        return
+
+    if haveDisplay():
+        try:
+            import tkinter
+            from tkinter import messagebox
+        except ImportError:
+            pass
+        else:
+            root = tkinter.Tk()
+            root.withdraw()
+            messagebox.showinfo(title, message, parent=root)
+            root.destroy()
+            return
+
+    # no GUI available, so ask on the console
+    input(title + ": " + message + " (press enter)")
+
+# EOF
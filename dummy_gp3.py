@@ -1,56 +1,199 @@
-import errno
+import argparse
 import random
+import select
 import socket
-import sys
+import threading
 import time
 
-import pupillography
+from constants import GAZEPOINT_REFRESH, PUPIL_MAX_SIZE_MM, PUPIL_MIN_SIZE_MM
+from gazepoint import CHANNELS, DEFAULT_CHANNELS, RECORD_END, RECORD_FORMAT, RECORD_TERMINATOR, SET_ID_REGEX
+
+class FakeEyes:
+    # random walk of pupil sizes and gaze positions, with optional invalid
+    # samples and blinks
+
+    CHANGE_MM = 0.10
+    CHANGE_POS = 0.01
+    BLINK_SECONDS = (0.1, 0.4) # shortest and longest blink
+
+    def __init__(self, rate, invalidRate=0.0, blinksPerMinute=0.0):
+        self.rate = rate
+        self.invalidRate = invalidRate # chance of each eye's sample being invalid
+        self.blinksPerMinute = blinksPerMinute
+        self.time = 0.00
+        self.right = 5.00
+        self.left = 4.80
+        self.pos = [0.5, 0.5, 0.4, 0.6] # left x, left y, right x, right y
+        self.blinkSamples = 0 # samples left in the current blink
+
+    def nextRecord(self):
+        # update data
+        self.right += (self.CHANGE_MM if random.getrandbits(1) else -self.CHANGE_MM)
+        self.left += (self.CHANGE_MM if random.getrandbits(1) else -self.CHANGE_MM)
+
+        # keep in bounds
+        self.right = min(max(self.right, PUPIL_MIN_SIZE_MM), PUPIL_MAX_SIZE_MM)
+        self.left = min(max(self.left, PUPIL_MIN_SIZE_MM), PUPIL_MAX_SIZE_MM)
+        for i in range(len(self.pos)):
+            self.pos[i] = min(max(self.pos[i] + random.uniform(-self.CHANGE_POS, self.CHANGE_POS), 0.0), 1.0)
+
+        # blinks lose both eyes for a while
+        if self.blinkSamples == 0 and random.random() < self.blinksPerMinute / (60.0 * self.rate):
+            self.blinkSamples = int(random.uniform(*self.BLINK_SECONDS) * self.rate)
+
+        if self.blinkSamples > 0:
+            self.blinkSamples -= 1
+            leftValid = rightValid = False
+        else:
+            leftValid = random.random() >= self.invalidRate
+            rightValid = random.random() >= self.invalidRate
+
+        record = RECORD_FORMAT.format(self.time, self.pos[0], self.pos[1], leftValid, self.pos[2], self.pos[3], rightValid,
+                                      (self.left if leftValid else 0.0), leftValid,
+                                      (self.right if rightValid else 0.0), rightValid)
+        self.time += 1.0 / self.rate
+        return record.encode()
+
+class FakeClient:
+    # sends data to one connection, in its own thread
+
+    def __init__(self, conn, args):
+        self.conn = conn
+        self.args = args
+        self.recordsSent = 0
+        self.keepRunning = True
+        self.extra = b'' # attributes of any other channels the client has enabled, all zero
+
+        # make each write go out on its own so fragments really are fragments
+        self.conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def run(self):
+        try:
+            if self.args.replay is not None:
+                from replay import SessionReplay # numpy is only needed for replaying
+                replay = SessionReplay(self.args.replay, (None if self.args.fast else self.args.speed))
+                replay.run(self.send)
+            else:
+                self.generate()
+        except (ConnectionResetError, BrokenPipeError):
+            pass
+        finally:
+            self.keepRunning = False
+            self.conn.close()
+
+        print("Pupillography program has stopped (", self.recordsSent, " records sent).", sep="")
+
+    def generate(self):
+        eyes = FakeEyes(self.args.rate or GAZEPOINT_REFRESH, self.args.invalid, self.args.blinks)
+        batchSize = max(1, self.args.batch)
+        start = time.perf_counter()
+        sent = 0
+
+        while self.keepRunning:
+            self.send(b''.join(eyes.nextRecord() for _ in range(batchSize)))
+            sent += batchSize
+
+            # sleep until the next batch is due, unless unthrottled
+            if self.args.rate > 0:
+                wait = start + sent / self.args.rate - time.perf_counter()
+                if wait > 0:
+                    time.sleep(wait)
+
+    def send(self, data):
+        self.ack()
+        if len(self.extra) > 0:
+            data = data.replace(RECORD_END + RECORD_TERMINATOR, self.extra + RECORD_END + RECORD_TERMINATOR)
+
+        if self.args.fragment > 0:
+            # split the data into random pieces to stress the receiver
+            i = 0
+            while i < len(data):
+                size = random.randint(1, self.args.fragment)
+                self.conn.sendall(data[i:i + size])
+                i += size
+        else:
+            self.conn.sendall(data)
+
+        self.recordsSent += data.count(b'\r\n')
+
+    def ack(self):
+        # acknowledge any commands the client has sent
+        readable, _, _ = select.select([self.conn], [], [], 0)
+        if not readable:
+            return
+
+        commands = self.conn.recv(4096)
+        if not commands:
+            raise ConnectionResetError()
+
+        for command in commands.decode(errors='replace').split('\r\n'):
+            setId = SET_ID_REGEX.match(command)
+            if setId is not None:
+                channel = setId.group(1)
+                if channel in CHANNELS and channel not in DEFAULT_CHANNELS and 'STATE="1"' in command:
+                    self.extra += "".join(' {}="0"'.format(name) for name, kind in CHANNELS[channel]).encode()
+                self.conn.sendall(str.encode('<ACK ID="' + setId.group(1) + '" STATE="1" />\r\n'))
+
+def reportRates(clients, interval=1.0):
+    # print the achieved records per second for each client and overall
+    last = {}
+    while True:
+        time.sleep(interval)
+        rates = []
+        for client in list(clients):
+            rates.append((client.recordsSent - last.get(client, 0)) / interval)
+            last[client] = client.recordsSent
+            if not client.keepRunning:
+                clients.remove(client)
+
+        if len(rates) > 0:
+            print("Sending {:.0f} records/s ({})".format(sum(rates), ", ".join("{:.0f}".format(r) for r in rates)))
 
 if __name__ == '__main__':
     HOST = '127.0.0.1'
     PORT = 4242
     ADDRESS = (HOST, PORT)
 
+    parser = argparse.ArgumentParser(description="Pretend to be a Gazepoint, sending random or recorded pupil data")
+    parser.add_argument("--rate", type=int, default=GAZEPOINT_REFRESH,
+                        help="records per second, e.g. 60, 150 or 1000; 0 for as fast as possible (default: %(default)s)")
+    parser.add_argument("--batch", type=int, default=1, help="records to pack into each write (default: 1)")
+    parser.add_argument("--fragment", type=int, default=0, metavar="BYTES",
+                        help="split writes into random pieces of up to this many bytes")
+    parser.add_argument("--invalid", type=float, default=0.0, metavar="P",
+                        help="chance of each eye's sample being invalid, between 0 and 1")
+    parser.add_argument("--blinks", type=float, default=0.0, metavar="PER_MINUTE", help="blinks per minute")
+    parser.add_argument("--clients", type=int, default=1, help="connections to accept before exiting (default: 1)")
+    parser.add_argument("--replay", metavar="SESSION", help="send a session file recorded by pupillography instead of random data")
+    parser.add_argument("--speed", type=float, default=1.0, help="replay speed, e.g. 2 for twice as fast (default: 1)")
+    parser.add_argument("--fast", action="store_true", help="replay as fast as possible")
+    args = parser.parse_args()
+
+    clients = []
+    threads = []
+    threading.Thread(target=reportRates, args=(clients,), daemon=True).start()
+
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
-        print("Waiting for connection...")
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         sock.bind(ADDRESS)
         sock.listen()
-        conn, addr = sock.accept()
-        print("Connected.")
-
-        with conn:
-            last_right = 5.00
-            last_left = 4.80
-            last_time = 0.00
-            change_mm = 0.10
-
-            keepRunning = True
-            print("Sending data to ", HOST, ":", PORT, "...", sep="")
-
-            while keepRunning:
-                outData = '<REC TIME="' + str(last_time) + '" LPOGX="0.5" LPOGY="0.5" LPOGV="1" RPOGX="0.4" RPOGY="0.6" RPOGV="1" LPMM="' + str(last_left) + '" LPMMV="1" RPMM="' + str(last_right) + '" RPMMV="1" />\r\n'
-
-                try:
-                    conn.send(str.encode(outData))
-                except socket.error as e:
-                    if e.errno == errno.WSAECONNRESET:
-                        print("Pupillography program has stopped.")
-                        keepRunning = False
-                    else:
-                        raise
-
-                # update data
-                last_right += (change_mm if random.getrandbits(1) else -change_mm)
-                last_left += (change_mm if random.getrandbits(1) else -change_mm)
-                last_time += 1.0 / pupillography.GAZEPOINT_REFRESH
-
-                # keep in bounds
-                last_right = max(last_right, pupillography.PUPIL_MIN_SIZE_MM)
-                last_right = min(last_right, pupillography.PUPIL_MAX_SIZE_MM)
-                last_left = max(last_left, pupillography.PUPIL_MIN_SIZE_MM)
-                last_left = min(last_left, pupillography.PUPIL_MAX_SIZE_MM)
-
-                time.sleep(1.0 / pupillography.GAZEPOINT_REFRESH)
+
+        for i in range(args.clients):
+            print("Waiting for connection...")
+            conn, addr = sock.accept()
+            print("Connected. Sending data to ", addr[0], ":", addr[1], "...", sep="")
+
+            client = FakeClient(conn, args)
+            clients.append(client)
+            threads.append(threading.Thread(target=client.run))
+            threads[-1].start()
+
+        try:
+            for thread in threads:
+                thread.join()
+        except KeyboardInterrupt:
+            for client in clients:
+                client.keepRunning = False
 
     print("Finished! Have a nice day.")
 
@@ -1,113 +1,274 @@
 # class for getting eye tracking data from a Gazepoint GP3 HD
 
-from datetime import datetime
-import re
+import asyncio
+import numpy as np
 import socket
-from time import sleep
+import sys
+import threading
+import time
 
-class EyeData:
-    systime = None
-    elapsed = None
-    lpogx = None
-    lpogy = None
-    lpogv = None
-    rpogx = None
-    rpogy = None
-    rpogv = None
-    lpmm = None
-    lpmmv = None
-    rpmm = None
-    rpmmv = None
-    delta = None
+from clocksync import ClockSync
+from constants import INVALID_READING
+from gazeclient import GazepointClient
+from gazerecords import RecordReader, RecordSchema
+from onlinestats import ChannelStats
+from samplestore import SampleStore, sampleDtype
+from sessionindex import Event
+from sessionwriter import SessionWriter, manifestPath, openSink
 
+class EyeData:
     HOST = '127.0.0.1'
     PORT = 4242
     ADDRESS = (HOST, PORT)
+    RECV_TIMEOUT = 0.5 # seconds
+    STORE_SECONDS = 300 # how much history to keep in memory
+    STATS_WINDOW_SECONDS = 10 # the recent statistics cover this long
+    EMA_SECONDS = 1.0 # time constant of the smoothed values
+    STATS_UPDATE_SECONDS = 0.25 # statistics are brought up to date this often, or when asked for
 
-    def __init__(self, outpath, refresh):
+    def __init__(self, outpath, refresh, host=None, port=None, channels=()):
         self.keepRunning = False
         self.haveData = False
         self.outpath = outpath
         self.refresh = refresh # Gazepoint refresh rate
+        if host is not None or port is not None:
+            self.HOST = (host if host is not None else self.HOST)
+            self.PORT = (port if port is not None else self.PORT)
+            self.ADDRESS = (self.HOST, self.PORT)
+        self.schema = RecordSchema(channels) # any Gazepoint channels to record as well as the usual ones
+        self.reader = RecordReader(self.schema)
+        # (firstDataTime, elapsedOffset): elapsed is Gazepoint TIME - firstDataTime + elapsedOffset.
+        # Set in one go so other threads (see elapsedAt) see a matching pair; None until the data starts.
+        self.timebase = None
+        self.resumeFrom = None # (elapsed, sampletime) of the last sample before a reconnect
+        self.client = None
+        self.samples = SampleStore(int(self.STORE_SECONDS * refresh), sampleDtype(self.schema.extraFields))
+        self.writer = None
+        self.sink = None # our file, if the writer is shared with other trackers
+        self.chunkBytes = None # split the session file into chunks of this many bytes
+        self.chunkSeconds = None # or this many seconds, see ChunkedSink
+        self.clock = ClockSync() # Gazepoint TIME <-> time.monotonic_ns()
+
+        # running statistics of the valid samples, for the whole session and the last few seconds.
+        # Updated a quarter of a second at a time, as updating them on every read cost more than
+        # everything else put together.
+        self.channelStats = {name: ChannelStats(int(self.STATS_WINDOW_SECONDS * refresh), self.EMA_SECONDS * refresh)
+                             for name in ('lpmm', 'rpmm', 'delta')}
+        self.statsSeq = 0 # next sample to add to the statistics
+        self.statsUpdateSamples = max(1, int(self.STATS_UPDATE_SECONDS * refresh))
+        self.statsLock = threading.Lock()
 
     def dataAvailable(self):
         return self.haveData
 
-    def run(self):
-        self.keepRunning = True
+    def latest(self):
+        # the most recent sample (see sampleDtype), or None if there isn't one
+        return self.samples.latest()
+
+    def statistics(self):
+        # {'lpmm', 'rpmm', 'delta'} -> dict of statistics (see ChannelStats.snapshot),
+        # cheap enough to call every frame
+        self.updateStatistics()
+        return {name: stats.snapshot() for name, stats in self.channelStats.items()}
+
+    def updateStatistics(self):
+        # add any samples the statistics haven't seen yet
+        with self.statsLock:
+            samples, self.statsSeq = self.samples.since(self.statsSeq)
+            if len(samples) == 0:
+                return
+
+            self.channelStats['lpmm'].add(samples['lpmm'], samples['lpmmv'])
+            self.channelStats['rpmm'].add(samples['rpmm'], samples['rpmmv'])
+            self.channelStats['delta'].add(samples['delta'], samples['lpmmv'] & samples['rpmmv'])
+
+    def statusLine(self):
+        # the recent statistics in a line of text
+        stats = self.statistics()
+        return "Left {:.2f} mm, right {:.2f} mm, difference {:.2f} +/- {:.2f} mm (last {}s)".format(
+            stats['lpmm']['windowMean'], stats['rpmm']['windowMean'],
+            stats['delta']['windowMean'], stats['delta']['windowSd'], self.STATS_WINDOW_SECONDS)
+
+    def elapsedAt(self, monotime):
+        # the elapsed time (as in the output file) matching a time.monotonic()
+        # time, e.g. when a camera frame was captured. None if there's no data.
+        hostNs = int(monotime * 1e9)
+        fit = self.clock.fit # the acquisition thread can reset the clock at any time, so just look once
+        timebase = self.timebase
+        if fit is not None and timebase is not None and hostNs >= fit[1]:
+            firstDataTime, elapsedOffset = timebase
+            return self.clock.trackerTime(hostNs, fit) - firstDataTime + elapsedOffset
 
-        # regex to extract data
-        dataRegex = re.compile(r'^<REC TIME="(.*)" LPOGX="(.*)" LPOGY="(.*)" LPOGV="(.*)" RPOGX="(.*)" RPOGY="(.*)" RPOGV="(.*)" LPMM="(.*)" LPMMV="(.*)" RPMM="(.*)" RPMMV="(.*)" />\r\n$')
+        # from before the latest reconnect, so look it up in the samples instead
+        samples = self.samples.last(self.samples.capacity)
+        if len(samples) == 0:
+            return None
 
-        with open(self.outpath, 'w') as outfile:
+        i = max(0, np.searchsorted(samples['sampletime'], hostNs, side='right') - 1)
+        return samples['elapsed'][i] + (hostNs - samples['sampletime'][i]) * 1e-9
+
+    def addEvent(self, kind, detail="", monotime=None):
+        # Marks something that happened, e.g. the target changing, in the
+        # session file and its index, at time.monotonic() time monotime or now.
+        # Safe to call from any thread; ignored when we aren't recording.
+        writer = self.writer
+        if writer is None:
+            return
+
+        hostNs = (time.monotonic_ns() if monotime is None else int(monotime * 1e9))
+        writer.writeEvent(Event(kind, detail, self.elapsedAt(hostNs * 1e-9), hostNs), self.sink)
+
+    def startWriter(self):
+        if self.chunkBytes is None and self.chunkSeconds is None:
             print("Writing to file:", self.outpath)
+        else:
+            print("Writing to files listed in:", manifestPath(self.outpath))
+        self.writer = SessionWriter(openSink(self.outpath, maxBytes=self.chunkBytes, maxSeconds=self.chunkSeconds,
+                                             dtype=self.samples.dtype))
+        self.writer.start()
+
+    def run(self):
+        self.keepRunning = True
+
+        self.startWriter()
 
+        try:
             # connect to the Gazepoint
             with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
                 try:
                     sock.connect(self.ADDRESS)
                 except:
                     print("ERROR: could not connect to Gazepoint (addr: ", self.HOST, ":", self.PORT, ") - is Gazepoint Control running?", sep="")
-                    pressEnter("Press enter to close the program")
+                    input("Press enter to close the program")
                     sys.exit(1)
 
-                sock.send(str.encode('<SET ID="ENABLE_SEND_TIME" STATE="1" />\r\n'))
-                sock.send(str.encode('<SET ID="ENABLE_SEND_PUPILMM" STATE="1" />\r\n'))
-                sock.send(str.encode('<SET ID="ENABLE_SEND_POG_LEFT" STATE="1" />\r\n'))
-                sock.send(str.encode('<SET ID="ENABLE_SEND_POG_RIGHT" STATE="1" />\r\n'))
-                sock.send(str.encode('<SET ID="ENABLE_SEND_DATA" STATE="1" />\r\n'))
+                for command in self.schema.enableCommands:
+                    sock.send(str.encode(command))
 
-                print("SystemTime,ElapsedTime,Right Pupil,Left Pupil,Difference,Right Pupil Valid,Left Pupil Valid,Right X,Left X,Right Y,Left Y,Right Pos Valid,Left Pos Valid", file=outfile)
+                # don't block forever so we notice when we've been stopped
+                sock.settimeout(self.RECV_TIMEOUT)
 
-                firstDataTime = None
+                self.reader = RecordReader(self.schema)
+                self.timebase = None
+                self.clock.reset()
                 while self.keepRunning:
-                    rxstr = bytes.decode(sock.recv(512))
-
-                    # pull out the pupil size data
-                    pupilData = dataRegex.match(rxstr)
-
-                    if pupilData is None:
+                    try:
+                        records = self.reader.read(sock)
+                    except socket.timeout:
                         continue
 
-                    # we subtract 0.5 from position data to set 0,0 as the middle of the screen
-                    self.systime = datetime.now().strftime('%Y-%m-%d_%H:%M:%S.%f')
-                    self.elapsed = float(pupilData.group(1))
-                    self.lpogx = float(pupilData.group(2)) - 0.5
-                    self.lpogy = (float(pupilData.group(3)) - 0.5) * -1
-                    self.lpogv = bool(pupilData.group(4) == "1")
-                    self.rpogx = float(pupilData.group(5)) - 0.5
-                    self.rpogy = (float(pupilData.group(6)) - 0.5) * -1
-                    self.rpogv = bool(pupilData.group(7) == "1")
-                    self.lpmm = float(pupilData.group(8))
-                    self.lpmmv = bool(pupilData.group(9) == "1")
-                    self.rpmm = float(pupilData.group(10))
-                    self.rpmmv = bool(pupilData.group(11) == "1")
-                    self.delta = (0 if not (self.lpmmv and self.rpmmv) else abs(self.lpmm - self.rpmm))
-
-                    if not self.lpmmv:
-                        self.lpmm = INVALID_READING
-                    if not self.rpmmv:
-                        self.rpmm = INVALID_READING
-
-                    # elapsed timestamp start at zero when Gazepoint Control is started, which is before we start collecting
-                    # data. Adjust it so the graph starts at time zero.
-                    if firstDataTime is None:
-                        firstDataTime = self.elapsed
-                    self.elapsed -= firstDataTime
-
-                    # flag that we have data so others can read it
-                    self.haveData = True
-
-                    print(self.systime, self.elapsed, self.rpmm, self.lpmm, self.delta, (1 if self.rpmmv else 0), (1 if self.lpmmv else 0),
-                          self.rpogx, self.lpogx, self.rpogy, self.lpogy, (1 if self.rpogv else 0), (1 if self.lpogv else 0),
-                          sep=',', file=outfile)
-
-                    sleep(1.0 / self.refresh)
+                    if records is None:
+                        print("Gazepoint closed the connection")
+                        break
+
+                    if len(records) > 0:
+                        self.handleRecords(records)
                 # end while keepRunning
             # end with socket
-        # end open
+        finally:
+            self.writer.stop()
+
+        print("Gazepoint stream:", self.reader.stats())
+
+    def runClient(self):
+        # like run(), but using the asyncio client: reconnects if Gazepoint
+        # Control restarts, and stops straight away when asked
+        self.keepRunning = True
+
+        self.startWriter()
+
+        try:
+            asyncio.run(self.makeClient().runUntilCancelled())
+        finally:
+            self.writer.stop()
+
+    def makeClient(self):
+        # the asyncio client for this tracker, for runClient() or to run alongside others on one loop
+        self.keepRunning = True
+        self.client = GazepointClient(self.HOST, self.PORT, handler=self.handleRecords, onConnect=self.reconnected,
+                                      schema=self.schema)
+        self.reader = self.client.reader
+        return self.client
+
+    def reconnected(self):
+        # Gazepoint restarts TIME from zero, so carry on from where we were
+        # once the data starts again (see handleRecords)
+        latest = self.samples.latest()
+        if latest is not None:
+            self.timebase = None
+            self.resumeFrom = (float(latest['elapsed']), int(latest['sampletime']))
+        self.clock.reset()
+
+    def handleRecords(self, records):
+        # all of the records from one read in one go, as parsed by RecordReader
+        recvtime = time.monotonic_ns()
+
+        # when each sample was taken, by our clock
+        self.clock.add(records['time'][-1], recvtime)
+
+        batch = np.empty(len(records), dtype=self.samples.dtype)
+        batch['recvtime'] = recvtime
+        batch['sampletime'] = self.clock.hostTime(records['time'])
+        batch['elapsed'] = records['time']
+
+        # we subtract 0.5 from position data to set 0,0 as the middle of the screen
+        batch['lpogx'] = records['lpogx'] - 0.5
+        batch['lpogy'] = (records['lpogy'] - 0.5) * -1
+        batch['lpogv'] = records['lpogv']
+        batch['rpogx'] = records['rpogx'] - 0.5
+        batch['rpogy'] = (records['rpogy'] - 0.5) * -1
+        batch['rpogv'] = records['rpogv']
+        batch['lpmmv'] = records['lpmmv']
+        batch['rpmmv'] = records['rpmmv']
+        batch['lpmm'] = np.where(batch['lpmmv'], records['lpmm'], INVALID_READING)
+        batch['rpmm'] = np.where(batch['rpmmv'], records['rpmm'], INVALID_READING)
+        batch['delta'] = np.where(batch['lpmmv'] & batch['rpmmv'], np.abs(records['lpmm'] - records['rpmm']), 0)
+
+        # any other channels go in as they are
+        for name, kind in self.schema.extraFields:
+            batch[name] = records[name]
+
+        # elapsed timestamp start at zero when Gazepoint Control is started, which is before we start collecting
+        # data. Adjust it so the graph starts at time zero.
+        if self.timebase is None:
+            elapsedOffset = 0.0
+            if self.resumeFrom is not None:
+                # after a reconnect, elapsed jumps by however long we were cut
+                # off, by our clock, and a reconnect event says by how much
+                lastElapsed, lastNs = self.resumeFrom
+                self.resumeFrom = None
+                gap = max(1.0 / self.refresh, (int(batch['sampletime'][0]) - lastNs) * 1e-9)
+                elapsedOffset = lastElapsed + gap
+                self.writer.writeEvent(Event("reconnect", "{:.3f}".format(gap), elapsedOffset,
+                                             int(batch['sampletime'][0])), self.sink)
+            self.timebase = (batch['elapsed'][0], elapsedOffset)
+        firstDataTime, elapsedOffset = self.timebase
+        batch['elapsed'] += elapsedOffset - firstDataTime
+
+        self.samples.extend(batch)
+        if self.samples.count - self.statsSeq >= self.statsUpdateSamples:
+            self.updateStatistics()
+
+        self.writer.write(batch, self.sink)
+
+        # flag that we have data so others can read it
+        self.haveData = True
+
+    def metrics(self):
+        # counters for each stage, see Metrics
+        return {"samples": self.samples.count,
+                "gazepoint": (self.client.metrics() if self.client is not None else self.reader.metrics()),
+                "clock": self.clock.metrics(),
+                "writer": (self.writer.metrics() if self.writer is not None else None)}
+
+    def stats(self):
+        return "{}; clock {}; writer {}".format((self.client.stats() if self.client is not None else self.reader.stats()),
+                                                self.clock.stats(),
+                                                (self.writer.stats() if self.writer is not None else "not started"))
 
     def stop(self):
         self.keepRunning = False
+        if self.client is not None:
+            self.client.stop()
 
 # EOF
@@ -1,10 +1,15 @@
 # show a series of fixation targets
 
-import ctypes
+from collections import OrderedDict
 import cv2
 import glob
+import numpy as np
 import os
 import sys
+import threading
+
+from constants import BASEDIR, FIXATION_TARGETS
+from dialogs import showMessage
 
 class FixationTargets:
     # path to targets
@@ -13,29 +18,80 @@ class FixationTargets:
 
     WINDOW_TITLE = "Fixation Targets"
 
-    def __init__(self, targetsdir):
-        # get our targets
-        self.targets = glob.glob(os.path.join(targetsdir, "*.png"))
+    # decoded targets, already scaled to the screen, most recently used last
+    MAX_CACHED_TARGETS = 32
 
-        if len(self.targets) < 1:
-            raise ValueError("No targets found in directory: " + targetsdir)
+    def __init__(self, targetsdir):
+        self.cache = OrderedDict()
+        self.cache_lock = threading.Lock()
+        self.preload_thread = None
+        self.display_size = None
 
         # window setup
         cv2.namedWindow(self.WINDOW_TITLE, cv2.WINDOW_NORMAL)
-        ctypes.windll.user32.MessageBoxW(0, "Move the fixation window to the correct monitor and press OK", "Window Position", 0)
+        showMessage("Window Position", "Move the fixation window to the correct monitor and press OK")
         cv2.setWindowProperty(self.WINDOW_TITLE, cv2.WND_PROP_FULLSCREEN, cv2.WINDOW_FULLSCREEN)
+        cv2.waitKey(10)
+
+        # scale the targets to the full screen window so showing one is just a copy
+        _, _, width, height = cv2.getWindowImageRect(self.WINDOW_TITLE)
+        if width > 0 and height > 0:
+            self.display_size = (width, height)
+
+        # get our targets
+        self.setTargetDir(targetsdir)
 
         # and start!
         self.showNextTarget()
 
+    def setTargetDir(self, targetsdir):
+        # switch to another set of targets, starting from the first one.
+        # Targets that are already cached aren't loaded again.
+        targets = sorted(glob.glob(os.path.join(targetsdir, "*.png")))
+
+        if len(targets) < 1:
+            raise ValueError("No targets found in directory: " + targetsdir)
+
+        self.targets = targets
+        self.target_index = -1
+
+        # load the rest in the background
+        self.preload_thread = threading.Thread(target=self.preload, args=(targets,), daemon=True)
+        self.preload_thread.start()
+
+    def preload(self, targets):
+        for target in targets[:self.MAX_CACHED_TARGETS]:
+            self.loadImage(target)
+
+    def loadImage(self, path):
+        with self.cache_lock:
+            img = self.cache.get(path)
+            if img is not None:
+                self.cache.move_to_end(path)
+                return img
+
+        img = cv2.imread(path)
+        if img is None:
+            raise ValueError("Could not read target: " + path)
+        if self.display_size is not None:
+            img = fitToDisplay(img, self.display_size)
+
+        with self.cache_lock:
+            self.cache[path] = img
+            self.cache.move_to_end(path)
+            while len(self.cache) > self.MAX_CACHED_TARGETS:
+                self.cache.popitem(last=False)
+
+        return img
+
     def __del__(self):
         cv2.destroyAllWindows()
 
     def showImage(self):
         print("Showing target:", self.currentImageName())
-        img = cv2.imread(self.targets[self.target_index])
+        img = self.loadImage(self.targets[self.target_index])
         cv2.imshow(self.WINDOW_TITLE, img)
-        cv2.waitKey(10)
+        cv2.waitKey(1)
 
     def showNextTarget(self):
         if (self.target_index + 1) >= len(self.targets):
@@ -56,17 +112,32 @@ class FixationTargets:
     def currentImageName(self):
         return os.path.split(self.targets[self.target_index])[1]
 
+def fitToDisplay(img, size):
+    # scale to fit the display without stretching, filling the edges with the
+    # colour of the image's corner
+    width, height = size
+    scale = min(width / img.shape[1], height / img.shape[0])
+    scaled = cv2.resize(img, (max(1, round(img.shape[1] * scale)), max(1, round(img.shape[0] * scale))),
+                        interpolation=(cv2.INTER_AREA if scale < 1 else cv2.INTER_LINEAR))
+
+    out = np.empty((height, width) + img.shape[2:], dtype=img.dtype)
+    out[:] = img[0, 0]
+    top = (height - scaled.shape[0]) // 2
+    left = (width - scaled.shape[1]) // 2
+    out[top:top + scaled.shape[0], left:left + scaled.shape[1]] = scaled
+    return out
+
 if __name__ == '__main__':
     def printUsage():
-        print("Usage:", os.path.split(__file__)[1], "<targets_dir>")
+        print("Usage:", os.path.split(__file__)[1], "[targets_dir=" + os.path.relpath(FIXATION_TARGETS, BASEDIR) + "]")
         print("      ", "all *.png files in the directory will be shown, in sorted order")
 
-    if len(sys.argv) < 2:
+    if len(sys.argv) > 1 and sys.argv[1] in ("-h", "--help"):
         printUsage()
         sys.exit(1)
 
     # targets needs to be a directory that exists
-    targetsdir = sys.argv[1]
+    targetsdir = (sys.argv[1] if len(sys.argv) > 1 else FIXATION_TARGETS)
     if not os.path.isdir(targetsdir):
         print("ERROR: targets_dir is not a valid directory", file=sys.stderr)
         sys.exit(1)
@@ -0,0 +1,199 @@
+# asyncio client for the Gazepoint data stream, with reconnects
+
+import asyncio
+import numpy as np
+import threading
+import time
+
+from gazepoint import ACK_REGEX, SET_ID_REGEX
+from gazerecords import RecordReader, RecordSchema
+from metrics import Histogram
+
+class GazepointClient:
+    # Connects to Gazepoint Control, enables the data stream and waits for each
+    # command to be acknowledged, then reads records until stopped. If the
+    # connection drops (e.g. Gazepoint Control is restarted) it reconnects,
+    # backing off between attempts.
+    #
+    # Batches of records (one per read) go into a bounded queue. If consumers
+    # fall behind, the oldest batches are thrown away rather than slowing down
+    # the socket, and counted in batchesDropped/recordsDropped.
+
+    CONNECT_TIMEOUT = 2.0 # seconds
+    ACK_TIMEOUT = 2.0
+    MIN_BACKOFF = 0.5
+    MAX_BACKOFF = 10.0
+    QUEUE_SIZE = 1024 # batches
+
+    def __init__(self, host='127.0.0.1', port=4242, handler=None, onConnect=None, schema=None):
+        self.host = host
+        self.port = port
+        self.schema = (schema if schema is not None else RecordSchema()) # which channels to enable
+        self.handler = handler # called on the event loop with each batch of records - keep it quick
+        self.onConnect = onConnect # called each time a connection is made
+        self.queue = None
+        self.loop = None
+        self.task = None
+        self.thread = None
+        self.connected = False
+        self.pendingAcks = set()
+        self.acked = None
+        self.stopRequested = False
+
+        # stats
+        self.connections = 0
+        self.batchesDropped = 0
+        self.recordsDropped = 0
+        self.handleTime = Histogram() # seconds the handler takes for each batch
+        self.reader = RecordReader(self.schema, onReply=self.reply)
+
+    def address(self):
+        return self.host + ":" + str(self.port)
+
+    async def run(self):
+        # runs until cancelled
+        self.loop = asyncio.get_running_loop()
+        self.task = asyncio.current_task()
+        self.queue = asyncio.Queue(self.QUEUE_SIZE)
+
+        consumer = None
+        if self.handler is not None:
+            consumer = asyncio.create_task(self.consume())
+
+        backoff = self.MIN_BACKOFF
+        try:
+            while not self.stopRequested:
+                try:
+                    reader, writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port),
+                                                            self.CONNECT_TIMEOUT)
+                except (OSError, asyncio.TimeoutError):
+                    print("Could not connect to Gazepoint (addr: ", self.address(), "), retrying in ", backoff, "s", sep="")
+                    await asyncio.sleep(backoff)
+                    backoff = min(backoff * 2, self.MAX_BACKOFF)
+                    continue
+
+                backoff = self.MIN_BACKOFF
+                try:
+                    await self.session(reader, writer)
+                    print("Gazepoint closed the connection, reconnecting")
+                except OSError as e:
+                    print("Gazepoint connection lost (", e, "), reconnecting", sep="")
+                finally:
+                    self.connected = False
+                    writer.close()
+        finally:
+            if consumer is not None:
+                consumer.cancel()
+
+                # hand over whatever was still waiting
+                while not self.queue.empty():
+                    self.handler(self.queue.get_nowait())
+            print("Gazepoint stream:", self.reader.stats())
+
+    async def session(self, reader, writer):
+        self.connections += 1
+        self.connected = True
+        self.reader.buffer = b''
+        if self.onConnect is not None:
+            self.onConnect()
+
+        # enable the data stream
+        self.pendingAcks = set()
+        self.acked = asyncio.Event()
+        for command in self.schema.enableCommands:
+            self.pendingAcks.add(SET_ID_REGEX.match(command).group(1))
+            writer.write(str.encode(command))
+        await writer.drain()
+
+        ackWait = asyncio.create_task(self.waitForAcks())
+        try:
+            while True:
+                data = await reader.read(RecordReader.RECV_SIZE)
+                if not data:
+                    return
+
+                records = self.reader.feed(data)
+                if len(records) > 0:
+                    self.publish(records)
+        finally:
+            ackWait.cancel()
+
+    def reply(self, line):
+        ack = ACK_REGEX.match(line)
+        if ack is not None:
+            self.pendingAcks.discard(ack.group(1).decode())
+            if len(self.pendingAcks) == 0:
+                self.acked.set()
+
+    async def waitForAcks(self):
+        try:
+            await asyncio.wait_for(self.acked.wait(), self.ACK_TIMEOUT)
+        except asyncio.TimeoutError:
+            print("WARNING: Gazepoint did not acknowledge:", ", ".join(sorted(self.pendingAcks)))
+
+    def publish(self, records):
+        # never wait for consumers: make room by dropping the oldest batch
+        while self.queue.full():
+            self.batchesDropped += 1
+            self.recordsDropped += len(self.queue.get_nowait())
+        self.queue.put_nowait(records)
+
+    async def batches(self):
+        # yields each batch of records as it arrives
+        while True:
+            yield await self.queue.get()
+
+    async def consume(self):
+        async for records in self.batches():
+            # If the handler has fallen behind (e.g. several trackers on one
+            # loop), take everything that's waiting in one go. Handling a batch
+            # costs much the same whatever its size.
+            if not self.queue.empty():
+                waiting = [records]
+                while not self.queue.empty():
+                    waiting.append(self.queue.get_nowait())
+                records = np.concatenate(waiting)
+
+            start = time.perf_counter()
+            self.handler(records)
+            self.handleTime.record(time.perf_counter() - start)
+
+    def metrics(self):
+        return dict(self.reader.metrics(),
+                    connected=self.connected,
+                    connections=self.connections,
+                    queued=(self.queue.qsize() if self.queue is not None else 0),
+                    batchesDropped=self.batchesDropped,
+                    recordsDropped=self.recordsDropped,
+                    handleTime=self.handleTime.snapshot())
+
+    def stats(self):
+        return "{}, {} connection(s), {} batches queued, {} records dropped from the queue, handler {}".format(
+            self.reader.stats(), self.connections, (self.queue.qsize() if self.queue is not None else 0),
+            self.recordsDropped, self.handleTime.summary())
+
+    def startThread(self):
+        # run the client on its own event loop in a background thread
+        self.thread = threading.Thread(target=asyncio.run, args=(self.runUntilCancelled(),))
+        self.thread.start()
+
+    async def runUntilCancelled(self):
+        try:
+            await self.run()
+        except asyncio.CancelledError:
+            pass
+
+    def stop(self):
+        # safe to call from any thread; stops straight away, even mid-read
+        self.stopRequested = True
+        if self.loop is not None and self.task is not None:
+            try:
+                self.loop.call_soon_threadsafe(self.task.cancel)
+            except RuntimeError:
+                pass # already finished
+
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+            self.thread = None
+
+# EOF
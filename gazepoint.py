@@ -0,0 +1,60 @@
+# the Gazepoint Open Gaze API: its data channels, commands and record format.
+# Imports nothing heavy, so the fake tracker can use it for free; the records
+# are parsed by gazerecords.
+
+import re
+
+RECORD_PREFIX = b'<REC '
+RECORD_END = b' />' # after the last attribute
+ACK_REGEX = re.compile(rb'<ACK ID="([^"]*)"')
+SET_ID_REGEX = re.compile(r'<SET ID="([^"]*)"')
+RECORD_TERMINATOR = b'\r\n'
+
+# for sending records of the DEFAULT_CHANNELS, e.g. from a fake Gazepoint
+RECORD_FORMAT = '<REC TIME="{:.5f}" LPOGX="{:.5f}" LPOGY="{:.5f}" LPOGV="{:d}" RPOGX="{:.5f}" RPOGY="{:.5f}" RPOGV="{:d}" LPMM="{:.5f}" LPMMV="{:d}" RPMM="{:.5f}" RPMMV="{:d}" />\r\n'
+
+# The data channels, by the ID that turns them on, and the attributes each
+# adds to every record with the type they are stored as: 'f8' numbers, 'i8'
+# counters and IDs, '?' valid flags. The Gazepoint decides the order the
+# attributes come in, so nothing here depends on it.
+CHANNEL_PREFIX = "ENABLE_SEND_"
+CHANNELS = {
+    "ENABLE_SEND_COUNTER": [("CNT", 'i8')],
+    "ENABLE_SEND_TIME": [("TIME", 'f8')],
+    "ENABLE_SEND_TIME_TICK": [("TIME_TICK", 'i8')],
+    "ENABLE_SEND_POG_FIX": [("FPOGX", 'f8'), ("FPOGY", 'f8'), ("FPOGS", 'f8'), ("FPOGD", 'f8'), ("FPOGID", 'i8'), ("FPOGV", '?')],
+    "ENABLE_SEND_POG_LEFT": [("LPOGX", 'f8'), ("LPOGY", 'f8'), ("LPOGV", '?')],
+    "ENABLE_SEND_POG_RIGHT": [("RPOGX", 'f8'), ("RPOGY", 'f8'), ("RPOGV", '?')],
+    "ENABLE_SEND_POG_BEST": [("BPOGX", 'f8'), ("BPOGY", 'f8'), ("BPOGV", '?')],
+    "ENABLE_SEND_PUPIL_LEFT": [("LPCX", 'f8'), ("LPCY", 'f8'), ("LPD", 'f8'), ("LPS", 'f8'), ("LPV", '?')],
+    "ENABLE_SEND_PUPIL_RIGHT": [("RPCX", 'f8'), ("RPCY", 'f8'), ("RPD", 'f8'), ("RPS", 'f8'), ("RPV", '?')],
+    "ENABLE_SEND_EYE_LEFT": [("LEYEX", 'f8'), ("LEYEY", 'f8'), ("LEYEZ", 'f8'), ("LPUPILD", 'f8'), ("LPUPILV", '?')],
+    "ENABLE_SEND_EYE_RIGHT": [("REYEX", 'f8'), ("REYEY", 'f8'), ("REYEZ", 'f8'), ("RPUPILD", 'f8'), ("RPUPILV", '?')],
+    "ENABLE_SEND_CURSOR": [("CX", 'f8'), ("CY", 'f8'), ("CS", 'i8')],
+    "ENABLE_SEND_BLINK": [("BKID", 'i8'), ("BKDUR", 'f8'), ("BKPMIN", 'f8')],
+    "ENABLE_SEND_PUPILMM": [("LPMM", 'f8'), ("LPMMV", '?'), ("RPMM", 'f8'), ("RPMMV", '?')],
+}
+
+# what every session records; any others are extra columns
+DEFAULT_CHANNELS = ("ENABLE_SEND_TIME", "ENABLE_SEND_PUPILMM", "ENABLE_SEND_POG_LEFT", "ENABLE_SEND_POG_RIGHT")
+
+def channelId(name):
+    # "pupil_left", "PUPIL_LEFT" or "ENABLE_SEND_PUPIL_LEFT" -> "ENABLE_SEND_PUPIL_LEFT"
+    name = name.strip().upper()
+    if not name.startswith(CHANNEL_PREFIX):
+        name = CHANNEL_PREFIX + name
+    if name not in CHANNELS:
+        raise ValueError("Unknown Gazepoint channel: " + name + " (known: " +
+                         ", ".join(channel[len(CHANNEL_PREFIX):] for channel in CHANNELS) + ")")
+    return name
+
+def parseChannels(text):
+    # a comma separated list from the command line, e.g. "pupil_left,cursor"
+    return [channelId(name) for name in text.split(',') if name.strip() != ""]
+
+def enableCommands(channels=DEFAULT_CHANNELS):
+    # commands sent to the Gazepoint to start the data stream
+    return tuple('<SET ID="' + channel + '" STATE="1" />\r\n' for channel in channels) + \
+           ('<SET ID="ENABLE_SEND_DATA" STATE="1" />\r\n',)
+
+# EOF
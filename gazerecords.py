@@ -0,0 +1,232 @@
+# parses the Gazepoint data stream into typed columns
+
+import numpy as np
+import operator
+
+from gazepoint import CHANNELS, DEFAULT_CHANNELS, RECORD_END, RECORD_PREFIX, RECORD_TERMINATOR, channelId, enableCommands
+
+class RecordSchema:
+    # What the records look like with a set of channels enabled, always
+    # including DEFAULT_CHANNELS as the rest of the program needs them.
+    # Records are parsed into an array of dtype, with a field for each
+    # attribute named in lower case (LPMM -> 'lpmm'). extraFields are the
+    # fields of the channels other than the default ones, which the
+    # SampleStore and session files add on to their own (see sampleDtype).
+
+    def __init__(self, channels=()):
+        self.channels = list(DEFAULT_CHANNELS)
+        for channel in map(channelId, channels):
+            if channel not in self.channels:
+                self.channels.append(channel)
+
+        attributes = [attribute for channel in self.channels for attribute in CHANNELS[channel]]
+        self.dtype = np.dtype([(name.lower(), kind) for name, kind in attributes])
+        self.fields = {name.encode(): name.lower() for name, kind in attributes} # attribute as sent -> field
+        self.extraFields = [(name.lower(), kind) for channel in self.channels[len(DEFAULT_CHANNELS):]
+                            for name, kind in CHANNELS[channel]]
+        self.enableCommands = enableCommands(self.channels)
+
+    def __repr__(self):
+        return "RecordSchema({!r})".format(self.channels[len(DEFAULT_CHANNELS):])
+
+class RecordReader:
+    # Accumulates bytes from the socket and parses every complete record into
+    # a row of schema.dtype. Any partial line is kept until the rest of it
+    # arrives, so records that are split across (or packed into) a single
+    # recv are never lost.
+    #
+    # A record is <REC NAME="value" NAME="value" ... />, so splitting it on
+    # the quotes gives the names and values in turn. Its layout, the record
+    # with the values taken out (<REC NAME="" NAME="" ... />), says which
+    # value goes in which field, whatever order they come in, and is only
+    # looked at once: every record after that with the same layout goes
+    # straight into the columns. Attributes not in the schema are
+    # ignored, and fields for attributes the records don't have are NaN (or 0
+    # for counters and valid flags).
+
+    RECV_SIZE = 65536
+
+    # a line this long without a terminator is garbage, not a slow record
+    MAX_LINE_LENGTH = 4096
+
+    # runs of up to this many records are made a row at a time, longer ones a column at a time
+    SMALL_RUN = 8
+
+    def __init__(self, schema=None, onReply=None):
+        self.schema = (schema if schema is not None else RecordSchema())
+        self.onReply = onReply # called with any line that isn't a data record
+        self.buffer = b''
+        self.layouts = {} # the layout of a record -> where its fields are, see layout()
+        self.empty = np.zeros(0, dtype=self.schema.dtype)
+        self.bytesReceived = 0
+        self.recordsParsed = 0
+        self.recordsDropped = 0
+
+    def feed(self, data):
+        # returns every complete record in data, as an array of schema.dtype
+        self.bytesReceived += len(data)
+        data = self.buffer + data
+
+        # whatever follows the final terminator waits for the next feed
+        end = data.rfind(RECORD_TERMINATOR)
+        end = (end + len(RECORD_TERMINATOR) if end >= 0 else 0)
+        self.buffer = data[end:]
+        if len(self.buffer) > self.MAX_LINE_LENGTH:
+            self.recordsDropped += 1
+            self.buffer = b''
+
+        if end == 0:
+            return self.empty
+
+        runs = self.splitBlock(data[:end])
+        if runs is None:
+            runs = self.splitLines(data[:end])
+
+        parsed = [self.columns(*run) for run in runs]
+        parsed = [records for records in parsed if records is not None]
+        if len(parsed) == 0:
+            return self.empty
+
+        records = (parsed[0] if len(parsed) == 1 else np.concatenate(parsed))
+        self.recordsParsed += len(records)
+        return records
+
+    def splitBlock(self, block):
+        # The usual case, where every line is a record with the same layout:
+        # one split of the whole block gives all of the values. Returns
+        # [(layout, values, count)] like splitLines, or None if the block
+        # isn't like that.
+        if not block.startswith(RECORD_PREFIX):
+            return None
+
+        width = block.count(b'"', 0, block.find(RECORD_TERMINATOR)) // 2 # values in the first record
+        parts = block.split(b'"')
+        layout = b'""'.join(parts[0:2 * width:2]) + b'""' + RECORD_END
+
+        # with the values taken out, the block is the same layout over and over
+        count = block.count(RECORD_TERMINATOR)
+        if width == 0 or b'""'.join(parts[0::2]) != (layout + RECORD_TERMINATOR) * count:
+            return None
+
+        return [(layout, parts[1::2], count)]
+
+    def splitLines(self, block):
+        # anything else - replies, garbled records, the channels changing - a
+        # line at a time, as runs of records with the same layout
+        runs = []
+        runLayout, runValues, runCount = None, [], 0
+        for line in block.split(RECORD_TERMINATOR)[:-1]:
+            if not line.startswith(RECORD_PREFIX):
+                # ACKs and other replies
+                if self.onReply is not None and len(line) > 0:
+                    self.onReply(line)
+                continue
+
+            parts = line.split(b'"')
+            layout = b'""'.join(parts[0::2])
+            if layout != runLayout:
+                if runCount > 0:
+                    runs.append((runLayout, runValues, runCount))
+                runLayout, runValues, runCount = layout, [], 0
+            runValues.extend(parts[1::2])
+            runCount += 1
+
+        if runCount > 0:
+            runs.append((runLayout, runValues, runCount))
+        return runs
+
+    def layout(self, layout):
+        # How to turn the values of a record with this layout into a row:
+        # (positions of the values to keep, or None for all of them, [(field,
+        # position among those kept)], [fields it doesn't have], a getter
+        # giving a row's values in dtype order). None if it isn't a well
+        # formed record.
+        if layout in self.layouts:
+            return self.layouts[layout]
+
+        names = layout.split(b'""') # what was between the values
+        attributes = [names[0][len(RECORD_PREFIX):]] + [name[1:] for name in names[1:-1]]
+        if len(names) < 2 or names[-1] != RECORD_END or not all(name.startswith(b' ') for name in names[1:-1]) or \
+                not all(attribute.endswith(b'=') for attribute in attributes):
+            plan = None
+        else:
+            attributes = [attribute[:-1] for attribute in attributes]
+            positions = [i for i, attribute in enumerate(attributes) if attribute in self.schema.fields]
+            fields = [(self.schema.fields[attributes[i]], j) for j, i in enumerate(positions)]
+            present = dict(fields)
+            missing = [field for field in self.schema.dtype.names if field not in present]
+            if len(missing) > 0:
+                print("WARNING: Gazepoint records have no", ", ".join(field.upper() for field in missing))
+
+            # a row has NaN then 0 after its values, for the missing fields
+            width = len(positions)
+            row = operator.itemgetter(*[present.get(field, (width if self.schema.dtype[field].kind == 'f' else width + 1))
+                                        for field in self.schema.dtype.names])
+            plan = ((None if width == len(attributes) else positions), fields, missing, row)
+
+        self.layouts[layout] = plan
+        return plan
+
+    def columns(self, layout, values, count):
+        # the records of one run as an array of schema.dtype, or None if there are none
+        plan = self.layout(layout)
+        if plan is None:
+            self.recordsDropped += count
+            return None
+
+        keep, fields, missing, row = plan
+        width = len(values) // count
+        if keep is not None:
+            # leave out the attributes we don't want, which might not even be numbers
+            values = [values[start + i] for start in range(0, len(values), width) for i in keep]
+            width = len(keep)
+
+        try:
+            numbers = list(map(float, values))
+        except ValueError:
+            # a value that isn't a number: keep the records that are all numbers
+            numbers = []
+            for start in range(0, len(values), width):
+                try:
+                    numbers.extend(list(map(float, values[start:start + width])))
+                except ValueError:
+                    self.recordsDropped += 1
+                    count -= 1
+            if count == 0:
+                return None
+
+        if count <= self.SMALL_RUN:
+            # a few records, as from a live tracker: a row at a time is quickest
+            padding = [np.nan, 0]
+            return np.array([row(numbers[i * width:(i + 1) * width] + padding) for i in range(count)], dtype=self.schema.dtype)
+
+        # otherwise each field is a column of them
+        numbers = np.array(numbers, dtype=np.float64).reshape(count, width)
+        records = np.empty(count, dtype=self.schema.dtype)
+        for field, j in fields:
+            records[field] = numbers[:, j]
+        for field in missing:
+            records[field] = (np.nan if records.dtype[field].kind == 'f' else 0)
+
+        return records
+
+    def read(self, sock):
+        # blocking read of whatever is available; None means the connection closed
+        try:
+            data = sock.recv(self.RECV_SIZE)
+        except ConnectionResetError:
+            return None
+
+        if not data:
+            return None
+
+        return self.feed(data)
+
+    def metrics(self):
+        return {"bytes": self.bytesReceived, "records": self.recordsParsed, "dropped": self.recordsDropped}
+
+    def stats(self):
+        return "received " + str(self.bytesReceived) + " bytes, parsed " + str(self.recordsParsed) + \
+               " records, dropped " + str(self.recordsDropped)
+
+# EOF
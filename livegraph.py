@@ -0,0 +1,222 @@
+# live graph of pupil size and gaze position
+
+import matplotlib.pyplot as plt
+import numpy as np
+from time import perf_counter
+
+from blink import BlinkFilter
+from metrics import Histogram
+
+RIGHT = 0
+LEFT = 1
+DELTA = 2
+
+class LiveGraph:
+    # Draws a moving window of the latest samples at a fixed frame rate,
+    # however fast the data comes in. The axes, labels and legends are drawn
+    # once and cached; each frame only redraws the lines and the cursor.
+
+    WINDOW_TITLE = "Pupil and X/Y Pos (close window to exit)"
+
+    def __init__(self, samples, windowSeconds=30, pointsPerSecond=8, refreshRate=20,
+                 pupilRange=(0, 10), invalidReading=0, onClose=None, sampleRate=None,
+                 statusText=None):
+        self.samples = samples # SampleStore to read from
+        self.windowSeconds = windowSeconds
+        self.pointsPerSecond = pointsPerSecond
+        self.pointsPerWindow = windowSeconds * pointsPerSecond
+        self.refreshRate = refreshRate # frames per second
+        self.pupilRange = pupilRange
+        self.onClose = onClose
+        self.statusText = statusText # called each frame for a line of text to show under the graphs
+        self.keepRunning = False
+
+        # each x-coord has right, left, and delta values
+        # accessed as plotPupilData[y-set]
+        # similar for X and Y coords, but no delta
+        self.xData = np.arange(self.pointsPerWindow) / pointsPerSecond
+        self.plotPupilData = np.full((3, self.pointsPerWindow), invalidReading, dtype=float)
+        self.plotXData = np.full((2, self.pointsPerWindow), invalidReading, dtype=float)
+        self.plotYData = np.full((2, self.pointsPerWindow), invalidReading, dtype=float)
+        self.xPos = 0
+        self.seq = 0 # next sample to read
+
+        # blinks are taken out of the pupil traces if we know the sample rate,
+        # otherwise invalid samples are drawn as invalidReading
+        self.blinkFilters = None
+        if sampleRate is not None:
+            self.blinkFilters = {LEFT: BlinkFilter(sampleRate), RIGHT: BlinkFilter(sampleRate)}
+        self.unpaired = {LEFT: np.empty(0), RIGHT: np.empty(0)} # times settled by one filter but not yet the other
+
+        self.fig = None
+        self.background = None
+
+        # performance stats
+        self.frames = 0
+        self.fps = 0.0
+        self.drawTime = 0.0 # seconds to draw the last frame
+        self.drawTimes = Histogram()
+        self.lastFrameTime = None
+
+    def setup(self):
+        # create three plots: pupils, x-pos, and y-pos
+        self.fig, self.axs = plt.subplots(3)
+
+        # plot config: exit on close window
+        self.fig.canvas.mpl_connect('close_event', self.closed)
+        self.fig.canvas.mpl_connect('draw_event', self.cacheBackground)
+        if self.fig.canvas.manager is not None:
+            self.fig.canvas.manager.set_window_title(self.WINDOW_TITLE)
+
+        axs = self.axs
+        axs[0].set_xlim([0, self.windowSeconds])
+        axs[0].set_ylim(list(self.pupilRange))
+        axs[0].set_title("Pupil size and X/Y position")
+        axs[0].set(ylabel="Pupil (mm)")
+        axs[1].set(ylabel="X-Pos")
+        axs[2].set(xlabel="Time (moving window in seconds)", ylabel="Y-Pos")
+
+        for a in (1, 2):
+            axs[a].sharex(axs[0])
+            axs[a].set_ylim([-0.5, 0.5])
+
+        # only these get redrawn each frame
+        self.pupilLines = [None, None, None]
+        self.xLines = [None, None]
+        self.yLines = [None, None]
+        for side, colour, label in [(LEFT, "blue", "Left"),
+                                    (RIGHT, "red", "Right"),
+                                    (DELTA, "green", "Difference")]:
+            self.pupilLines[side], = axs[0].plot(self.xData, self.plotPupilData[side], c=colour, label=label, animated=True)
+
+            if side != DELTA:
+                self.xLines[side], = axs[1].plot(self.xData, self.plotXData[side], c=colour, label=label, animated=True)
+                self.yLines[side], = axs[2].plot(self.xData, self.plotYData[side], c=colour, label=label, animated=True)
+
+        # the vertical line showing the current time
+        self.currentLines = [ax.axvline(0, c="black", label="Current Time", animated=True) for ax in axs]
+
+        for ax in axs:
+            ax.legend()
+
+        self.status = self.fig.text(0.01, 0.01, "", animated=True)
+
+    def artists(self):
+        return self.pupilLines + self.xLines + self.yLines + self.currentLines + [self.status]
+
+    def cacheBackground(self, event):
+        # called whenever the whole figure is redrawn, e.g. after a resize
+        self.background = self.fig.canvas.copy_from_bbox(self.fig.bbox)
+        for artist in self.artists():
+            self.fig.draw_artist(artist)
+
+    def addSamples(self, samples):
+        # write a batch of samples into the plot windows in one go
+        xPositions = (samples['elapsed'] * self.pointsPerSecond).astype(int) % self.pointsPerWindow
+        self.xPos = xPositions[-1]
+
+        for side, x, y in [(LEFT, 'lpogx', 'lpogy'), (RIGHT, 'rpogx', 'rpogy')]:
+            self.plotXData[side][xPositions] = samples[x]
+            self.plotYData[side][xPositions] = samples[y]
+
+        if self.blinkFilters is None:
+            for side, diam in [(LEFT, 'lpmm'), (RIGHT, 'rpmm')]:
+                self.plotPupilData[side][xPositions] = samples[diam]
+            self.plotPupilData[DELTA][xPositions] = samples['delta']
+            return
+
+        # The filters hold samples back until they know whether they're part
+        # of a blink, so the pupil traces lag a little behind the gaze traces.
+        # Long gaps come out as NaN, which matplotlib leaves blank.
+        for side, diam, valid in [(LEFT, 'lpmm', 'lpmmv'), (RIGHT, 'rpmm', 'rpmmv')]:
+            t, diameter, flags = self.blinkFilters[side].pushBatch(samples['elapsed'], samples[diam], samples[valid])
+            positions = (t * self.pointsPerSecond).astype(int) % self.pointsPerWindow
+            self.plotPupilData[side][positions] = diameter
+            self.unpaired[side] = np.concatenate([self.unpaired[side], t])
+
+        # Each filter settles the samples in the order they came, but one eye
+        # can get further ahead than the other (e.g. while the other is in a
+        # blink), so the delta only goes as far as both have got; the rest
+        # waits for the eye that's behind.
+        paired = min(len(self.unpaired[LEFT]), len(self.unpaired[RIGHT]))
+        changed = (self.unpaired[LEFT][:paired] * self.pointsPerSecond).astype(int) % self.pointsPerWindow
+        for side in (LEFT, RIGHT):
+            self.unpaired[side] = self.unpaired[side][paired:]
+        self.plotPupilData[DELTA][changed] = np.abs(self.plotPupilData[LEFT][changed] - self.plotPupilData[RIGHT][changed])
+
+    def step(self):
+        # pull in new samples and draw one frame. Returns False if there was nothing new.
+        samples, self.seq = self.samples.since(self.seq)
+        if len(samples) == 0 or self.background is None:
+            self.fig.canvas.flush_events()
+            return False
+
+        self.addSamples(samples)
+
+        start = perf_counter()
+        for side in (LEFT, RIGHT, DELTA):
+            self.pupilLines[side].set_ydata(self.plotPupilData[side])
+        for side in (LEFT, RIGHT):
+            self.xLines[side].set_ydata(self.plotXData[side])
+            self.yLines[side].set_ydata(self.plotYData[side])
+
+        currentTime = self.xPos / self.pointsPerSecond
+        for line in self.currentLines:
+            line.set_xdata([currentTime, currentTime])
+        if self.statusText is not None:
+            self.status.set_text(self.statusText())
+
+        canvas = self.fig.canvas
+        canvas.restore_region(self.background)
+        for artist in self.artists():
+            self.fig.draw_artist(artist)
+        canvas.blit(self.fig.bbox)
+        canvas.flush_events()
+
+        end = perf_counter()
+        self.drawTime = end - start
+        self.drawTimes.record(self.drawTime)
+        self.frames += 1
+        if self.lastFrameTime is not None:
+            # smoothed so the number is readable
+            self.fps = 0.9 * self.fps + 0.1 / max(end - self.lastFrameTime, 1e-6)
+        self.lastFrameTime = end
+        return True
+
+    def run(self):
+        if self.fig is None:
+            self.setup()
+
+        self.fig.show()
+        self.fig.canvas.draw() # caches the background
+        self.keepRunning = True
+
+        period = 1.0 / self.refreshRate
+        nextFrame = perf_counter()
+        while self.keepRunning:
+            self.step()
+
+            nextFrame += period
+            wait = nextFrame - perf_counter()
+            if wait > 0:
+                # keeps the window responsive while we wait for the next frame
+                self.fig.canvas.start_event_loop(wait)
+            else:
+                # running behind, so don't try to catch up
+                nextFrame = perf_counter()
+
+    def closed(self, event):
+        self.keepRunning = False
+        if self.onClose is not None:
+            self.onClose(event)
+
+    def stop(self):
+        self.keepRunning = False
+
+    def stats(self):
+        return "{:.1f} fps, {:.1f} ms per frame (draw {})".format(self.fps, self.drawTime * 1000, self.drawTimes.summary())
+
+    def metrics(self):
+        return {"frames": self.frames, "fps": self.fps, "drawTime": self.drawTimes.snapshot(), "samplesRead": self.seq}
+
+# EOF
@@ -0,0 +1,172 @@
+# counters and timings from each part of the pipeline, logged and queryable while running
+
+import bisect
+import json
+import sys
+import threading
+import time
+
+class RateMeter:
+    # Counts events, e.g. frames, and works out how many per second. The rate
+    # is worked out when it's read, so once there's been no tick for an
+    # interval it's 0, rather than the last rate from before they stopped.
+    def __init__(self, interval=1.0):
+        self.interval = interval
+        self.lastRate = 0.0 # over the last full interval
+        self.count = 0
+        self.start = self.lastTick = time.perf_counter()
+
+    def tick(self, n=1):
+        self.count += n
+        now = self.lastTick = time.perf_counter()
+        if now - self.start >= self.interval:
+            self.lastRate = self.count / (now - self.start)
+            # start before count, so a reader never sees the new count with the old start
+            self.start = now
+            self.count = 0
+
+    @property
+    def rate(self):
+        # safe to read from any thread
+        count = self.count
+        now = time.perf_counter()
+        if now - self.lastTick >= self.interval:
+            return 0.0 # stalled
+
+        elapsed = now - self.start
+        if elapsed < self.interval:
+            return self.lastRate
+
+        # slowed down, so the interval isn't over yet: what has been counted so far
+        return count / elapsed
+
+class Histogram:
+    # Timings (in seconds) counted in log-spaced buckets, 16 per decade from
+    # 1us to 100s, so recording one costs about as much as a dict lookup.
+    # Percentiles are the top of their bucket, so up to 15% high.
+
+    BOUNDS = [10 ** (i / 16) for i in range(-96, 33)]
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        self.counts[bisect.bisect_left(self.BOUNDS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, p):
+        if self.count == 0:
+            return None
+
+        target = p / 100 * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= target:
+                break
+        return min(self.BOUNDS[i] if i < len(self.BOUNDS) else self.max, self.max)
+
+    def snapshot(self):
+        # the same keys as the benchmark results
+        if self.count == 0:
+            return None
+
+        return {"count": self.count,
+                "mean": self.total / self.count,
+                "p50": self.percentile(50),
+                "p95": self.percentile(95),
+                "p99": self.percentile(99),
+                "max": self.max}
+
+    def summary(self):
+        if self.count == 0:
+            return "none yet"
+        return "p50 {:.1f} ms, p95 {:.1f} ms".format(self.percentile(50) * 1000, self.percentile(95) * 1000)
+
+class Metrics:
+    # The parts of the pipeline to report on. Each has metrics(), returning a
+    # dict for the query interface, and stats(), returning a short string for
+    # the log. Both are only called when someone asks, so the parts just keep
+    # plain counters and the cost of leaving this on is tiny.
+
+    def __init__(self):
+        self.components = {}
+        self.stopped = threading.Event()
+        self.logThread = None
+        self.server = None
+
+    def add(self, name, component):
+        self.components[name] = component
+
+    def snapshot(self):
+        results = {"time": time.time()}
+        for name, component in list(self.components.items()):
+            try:
+                results[name] = component.metrics()
+            except Exception as e:
+                results[name] = {"error": str(e)}
+        return results
+
+    def statsLine(self):
+        parts = []
+        for name, component in list(self.components.items()):
+            try:
+                parts.append(name + ": " + component.stats())
+            except Exception as e:
+                parts.append(name + ": " + str(e))
+        return "; ".join(parts)
+
+    def startLogging(self, interval, outfile=None):
+        # prints the stats line every interval seconds
+        def log():
+            while not self.stopped.wait(interval):
+                print("Stats:", self.statsLine(), file=(outfile or sys.stdout), flush=True)
+
+        self.logThread = threading.Thread(target=log, daemon=True)
+        self.logThread.start()
+
+    def serve(self, port, host='127.0.0.1'):
+        # GET /metrics for JSON, /stats for the log line. Local only by default.
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == '/metrics':
+                    body = json.dumps(metrics.snapshot(), indent=2, default=float).encode()
+                    contentType = 'application/json'
+                elif self.path == '/stats':
+                    body = (metrics.statsLine() + '\n').encode()
+                    contentType = 'text/plain'
+                else:
+                    self.send_error(404)
+                    return
+
+                self.send_response(200)
+                self.send_header('Content-Type', contentType)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass # don't clutter the console with every request
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        print("Metrics at: http://" + host + ":" + str(self.server.server_address[1]) + "/metrics")
+
+    def stop(self):
+        self.stopped.set()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+# EOF
@@ -0,0 +1,169 @@
+# record from several Gazepoints at once, in one process
+
+import argparse
+import asyncio
+from datetime import datetime
+import os
+import signal
+import sys
+import time
+
+from clocksync import clockAnchor
+from constants import GAZEPOINT_REFRESH, RESULTS_DIR
+from eyedata import EyeData
+from gazepoint import parseChannels
+from metrics import Metrics
+from sessionwriter import BINARY_EXTENSION, SessionWriter, openSink
+
+class MultiTracker:
+    # All the trackers share one asyncio loop, on one thread, for their
+    # connections, and one writer thread for their files. Each still has its
+    # own EyeData, so its own session file, SampleStore, clock fit and
+    # statistics. The files share one clock anchor and every sampletime is on
+    # the same host clock, so the streams can be lined up afterwards.
+
+    RATE_INTERVAL = 1.0 # seconds between throughput updates
+
+    def __init__(self, endpoints, outpaths, refresh=GAZEPOINT_REFRESH, chunkBytes=None, chunkSeconds=None, channels=()):
+        self.writer = SessionWriter()
+        self.chunkBytes = chunkBytes # split each session into chunks, see ChunkedSink
+        self.chunkSeconds = chunkSeconds
+        self.devices = [EyeData(outpath, refresh, host, port, channels) for (host, port), outpath in zip(endpoints, outpaths)]
+        for device in self.devices:
+            device.writer = self.writer
+
+        self.loop = None
+        self.statusInterval = None
+        self.rates = [0.0] * len(self.devices) # samples per second from each tracker
+        self.loopLoad = 0.0 # fraction of a core the loop thread is using
+
+    def name(self, device):
+        return device.HOST + ":" + str(device.PORT)
+
+    def run(self, statusInterval=None):
+        # blocks until stop(), Ctrl+C or SIGTERM; prints stats() every statusInterval seconds
+        self.statusInterval = statusInterval
+        anchor = clockAnchor()
+        for device in self.devices:
+            print("Writing", self.name(device), "to file:", device.outpath)
+            device.sink = openSink(device.outpath, anchor, self.chunkBytes, self.chunkSeconds, device.samples.dtype)
+            self.writer.addSink(device.sink)
+
+        self.writer.start()
+        try:
+            asyncio.run(self.runClients())
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.writer.stop()
+
+        print(self.stats())
+
+    async def runClients(self):
+        self.loop = asyncio.get_running_loop()
+        try:
+            self.loop.add_signal_handler(signal.SIGTERM, self.stop)
+        except (NotImplementedError, AttributeError):
+            pass # not on Windows
+
+        clients = [device.makeClient() for device in self.devices]
+        monitor = asyncio.create_task(self.monitor())
+        try:
+            await asyncio.gather(*(client.runUntilCancelled() for client in clients))
+        finally:
+            monitor.cancel()
+
+    async def monitor(self):
+        # throughput and load, worked out on the loop so it needs no thread of its own
+        counts = [device.samples.count for device in self.devices]
+        last = time.perf_counter()
+        lastCpu = time.thread_time()
+        lastStatus = last
+
+        while True:
+            await asyncio.sleep(self.RATE_INTERVAL)
+            now = time.perf_counter()
+            cpu = time.thread_time()
+            newCounts = [device.samples.count for device in self.devices]
+            self.rates = [(new - old) / (now - last) for new, old in zip(newCounts, counts)]
+            self.loopLoad = (cpu - lastCpu) / (now - last)
+            counts, last, lastCpu = newCounts, now, cpu
+
+            if self.statusInterval is not None and now - lastStatus >= self.statusInterval:
+                print(self.stats(), flush=True)
+                lastStatus = now
+
+    def stop(self):
+        # safe to call from any thread
+        for device in self.devices:
+            device.stop()
+
+    def metrics(self):
+        return {"samplesPerSecond": sum(self.rates),
+                "loopLoad": self.loopLoad,
+                "trackers": {self.name(device): dict(device.metrics(), samplesPerSecond=rate)
+                             for device, rate in zip(self.devices, self.rates)},
+                "writer": self.writer.metrics()}
+
+    def stats(self):
+        return "{:.0f} samples/s from {} trackers ({}), loop at {:.0%} of a core, {} samples in total; writer {}".format(
+            sum(self.rates), len(self.devices), ", ".join("{:.0f}".format(rate) for rate in self.rates),
+            self.loopLoad, sum(device.samples.count for device in self.devices), self.writer.stats())
+
+def parseEndpoint(text):
+    # "host:port", or just "port" for this computer
+    host, _, port = text.rpartition(':')
+    return (host or EyeData.HOST, int(port))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Record from several Gazepoints at once, each to its own session file")
+    parser.add_argument("endpoints", nargs="+", metavar="HOST:PORT", help="Gazepoint Control servers to connect to")
+    parser.add_argument("--refresh", type=int, default=GAZEPOINT_REFRESH, help="records per second from each tracker (default: %(default)s)")
+    parser.add_argument("--outdir", default=RESULTS_DIR,
+                        help="where to write the session files (default: results)")
+    parser.add_argument("--binary", action="store_true", help="write binary session files instead of CSV")
+    parser.add_argument("--chunk-minutes", type=float, metavar="M", help="split each session into files of at most M minutes")
+    parser.add_argument("--chunk-mb", type=float, metavar="N", help="split each session into files of at most N megabytes")
+    parser.add_argument("--channels", default="", metavar="NAMES",
+                        help="other Gazepoint channels to record as well, e.g. pupil_left,cursor")
+    parser.add_argument("--metrics", type=int, metavar="PORT", help="serve counters at http://127.0.0.1:PORT/metrics")
+    parser.add_argument("--status", type=float, default=10, metavar="SECONDS", help="seconds between status lines (default: %(default)s)")
+    args = parser.parse_args()
+
+    try:
+        endpoints = [parseEndpoint(endpoint) for endpoint in args.endpoints]
+    except ValueError:
+        print("ERROR: endpoints should look like 127.0.0.1:4242", file=sys.stderr)
+        sys.exit(1)
+
+    try:
+        channels = parseChannels(args.channels)
+    except ValueError as e:
+        print("ERROR:", e, file=sys.stderr)
+        sys.exit(1)
+
+    os.makedirs(args.outdir, exist_ok=True)
+    timestamp = datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
+    extension = (BINARY_EXTENSION if args.binary else ".csv")
+    outpaths = []
+    seen = {}
+    for host, port in endpoints:
+        # the same tracker twice (e.g. testing with dummy_gp3) gets numbered files
+        name = timestamp + "_" + host + "_" + str(port)
+        seen[name] = seen.get(name, 0) + 1
+        if endpoints.count((host, port)) > 1:
+            name += "_" + str(seen[name])
+        outpaths.append(os.path.join(args.outdir, name + extension))
+
+    trackers = MultiTracker(endpoints, outpaths, args.refresh,
+                            (None if args.chunk_mb is None else int(args.chunk_mb * 1e6)),
+                            (None if args.chunk_minutes is None else args.chunk_minutes * 60), channels)
+    metrics = Metrics()
+    metrics.add("trackers", trackers)
+    if args.metrics is not None:
+        metrics.serve(args.metrics)
+
+    trackers.run(args.status)
+    metrics.stop()
+
+# EOF
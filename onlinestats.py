@@ -0,0 +1,159 @@
+# running statistics of pupil data, updated as each batch of samples arrives
+
+import numpy as np
+import threading
+
+class RunningStats:
+    # mean and variance of everything added so far (Welford's method, a
+    # batch at a time)
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0 # sum of squared differences from the mean
+
+    def add(self, values):
+        n = len(values)
+        if n == 0:
+            return
+
+        mean = values.mean()
+        m2 = ((values - mean) ** 2).sum()
+        total = self.count + n
+        diff = mean - self.mean
+        self.mean += diff * n / total
+        self.m2 += m2 + diff * diff * self.count * n / total
+        self.count = total
+
+    def variance(self):
+        return (self.m2 / (self.count - 1) if self.count > 1 else np.nan)
+
+class Ema:
+    # exponential moving average with a time constant in samples
+
+    def __init__(self, samples):
+        self.alpha = 1.0 - np.exp(-1.0 / max(samples, 1e-9))
+        self.value = np.nan
+
+    def add(self, values):
+        if len(values) == 0:
+            return
+
+        if np.isnan(self.value):
+            self.value = values[0]
+
+        # the same as applying each value in turn
+        weights = (1.0 - self.alpha) ** np.arange(len(values) - 1, -1, -1)
+        self.value = self.value * (1.0 - self.alpha) ** len(values) + self.alpha * np.dot(weights, values)
+
+class Histogram:
+    # counts of values in fixed bins, so the median can be kept up to date
+    # in O(1) per value, to within the bin width
+
+    def __init__(self, low, high, resolution):
+        self.low = low
+        self.resolution = resolution
+        self.counts = np.zeros(int(np.ceil((high - low) / resolution)) + 1, dtype=np.int64)
+        self.count = 0
+
+    def bins(self, values):
+        # np.clip is surprisingly slow on small arrays
+        return np.minimum(np.maximum(((values - self.low) / self.resolution).astype(int), 0), len(self.counts) - 1)
+
+    def add(self, values):
+        np.add.at(self.counts, self.bins(values), 1)
+        self.count += len(values)
+
+    def remove(self, values):
+        np.subtract.at(self.counts, self.bins(values), 1)
+        self.count -= len(values)
+
+    def median(self):
+        if self.count == 0:
+            return np.nan
+
+        middle = np.searchsorted(np.cumsum(self.counts), (self.count + 1) / 2)
+        return self.low + (middle + 0.5) * self.resolution
+
+class WindowStats:
+    # mean, variance and median of the valid values among the last `size`
+    # samples. Invalid samples still take up room in the window, so it always
+    # covers the same length of time.
+
+    def __init__(self, size, low, high, resolution):
+        self.ring = np.full(size, np.nan)
+        self.pos = 0
+        self.count = 0
+        self.shift = None # sums are kept relative to this, so the variance doesn't lose precision
+        self.sum = 0.0
+        self.sumSquares = 0.0
+        self.histogram = Histogram(low, high, resolution)
+
+    def add(self, values, valid):
+        # only the newest values can still be in the window
+        values = np.where(valid, values, np.nan)[-len(self.ring):]
+        if self.shift is None and not np.isnan(values).all():
+            self.shift = values[~np.isnan(values)][0]
+
+        positions = (self.pos + np.arange(len(values))) % len(self.ring)
+        self.pos = (self.pos + len(values)) % len(self.ring)
+
+        old = self.ring[positions]
+        old = old[~np.isnan(old)]
+        new = values[~np.isnan(values)]
+        self.ring[positions] = values
+
+        self.count += len(new) - len(old)
+        if self.count == 0:
+            # start again from zero, which also clears any rounding errors
+            self.sum = self.sumSquares = 0.0
+        else:
+            self.sum += (new - self.shift).sum() - (old - self.shift).sum()
+            self.sumSquares += ((new - self.shift) ** 2).sum() - ((old - self.shift) ** 2).sum()
+
+        self.histogram.remove(old)
+        self.histogram.add(new)
+
+    def mean(self):
+        return (self.shift + self.sum / self.count if self.count > 0 else np.nan)
+
+    def variance(self):
+        if self.count < 2:
+            return np.nan
+        return max(0.0, (self.sumSquares - self.sum * self.sum / self.count) / (self.count - 1))
+
+class ChannelStats:
+    # everything we keep for one channel, e.g. the left pupil size
+
+    def __init__(self, windowSize, emaSize, low=0.0, high=10.0, resolution=0.01):
+        self.session = RunningStats()
+        self.sessionHistogram = Histogram(low, high, resolution)
+        self.window = WindowStats(windowSize, low, high, resolution)
+        self.ema = Ema(emaSize)
+        self.lock = threading.Lock()
+
+    def add(self, values, valid):
+        values = np.asarray(values, dtype=float)
+        valid = np.asarray(valid, dtype=bool)
+        good = values[valid]
+
+        with self.lock:
+            self.session.add(good)
+            self.sessionHistogram.add(good)
+            self.window.add(values, valid)
+            self.ema.add(good)
+
+    def snapshot(self):
+        # a dict of the current values, NaN where there's no valid data yet
+        with self.lock:
+            return {"count": self.session.count,
+                    "mean": (self.session.mean if self.session.count > 0 else np.nan),
+                    "sd": np.sqrt(self.session.variance()),
+                    "median": self.sessionHistogram.median(),
+                    "ema": self.ema.value,
+                    "windowCount": self.window.count,
+                    "windowMean": self.window.mean(),
+                    "windowSd": np.sqrt(self.window.variance()),
+                    "windowMedian": self.window.histogram.median()}
+
+# EOF
@@ -0,0 +1,48 @@
+# one command for all of the programs: python pupil.py <command> [options]
+
+import os
+import runpy
+import sys
+
+# command -> (module, what it does). A command only imports its own module,
+# so e.g. the fake tracker never loads the camera or graph libraries. Each
+# module's options are the same as running it directly.
+COMMANDS = {
+    "record": ("pupillography", "record a session with the targets, camera and live graph, or --headless"),
+    "record-many": ("multitracker", "record from several trackers at once"),
+    "fake-tracker": ("dummy_gp3", "pretend to be a Gazepoint, sending random or recorded data"),
+    "targets": ("fixation", "show the fixation targets"),
+    "webcam": ("webcam", "camera preview, click to take photos"),
+    "analyze": ("analysis", "pupil light reflex metrics for recorded sessions"),
+    "export": ("sessionwriter", "convert a binary session to CSV"),
+    "events": ("sessionindex", "list the events in a session"),
+}
+
+def printUsage():
+    print("Usage:", os.path.split(__file__)[1], "<command> [options]")
+    print("      ", os.path.split(__file__)[1], "<command> --help for the command's options")
+    print()
+    width = max(len(command) for command in COMMANDS)
+    for command, (module, description) in COMMANDS.items():
+        print("   ", command.ljust(width), "", description)
+
+def main(args):
+    if len(args) == 0 or args[0] in ("-h", "--help", "help"):
+        printUsage()
+        return 1
+
+    if args[0] not in COMMANDS:
+        print("ERROR: unknown command:", args[0], file=sys.stderr)
+        printUsage()
+        return 1
+
+    # run the module as if it had been started itself
+    module = COMMANDS[args[0]][0]
+    sys.argv = [os.path.join(os.path.split(os.path.abspath(__file__))[0], module + ".py")] + args[1:]
+    runpy.run_module(module, run_name='__main__', alter_sys=True)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
+
+# EOF
@@ -1,174 +1,165 @@
 # Basic pupillography using the Gazepoint GP3 HD eye tracker
 
-import ctypes
-import cv2
+import csv
 from datetime import datetime
-import matplotlib
-matplotlib.use('TkAgg')
-import matplotlib.pyplot as plt
 import os
-from pynput import keyboard
+import signal
 import sys
 import threading
-from time import sleep
+from time import monotonic, sleep
 
+from constants import (FIXATION_TARGETS, GAZEPOINT_REFRESH, IMAGE_OUTDIR, INVALID_READING, PUPIL_MAX_SIZE_MM,
+                       PUPIL_MIN_SIZE_MM, RESULTS_DIR, VIDEO_EXTENSION)
 from eyedata import EyeData
-from fixation import FixationTargets
-from webcam import PupilWebcam
+from gazepoint import parseChannels
+from metrics import Metrics
+from sessionwriter import MANIFEST_EXTENSION
+
+# The windows, graph and keyboard hooks are only imported when they're used,
+# so a headless capture (--headless) doesn't load any GUI modules.
 
 WINDOW_SIZE_SECONDS = 30
-FRAMES_PER_SECOND = 8
+FRAMES_PER_SECOND = 8 # points per second in the graph window
+GRAPH_REFRESH_RATE = 20 # graph redraws per second
 FRAMES_PER_WINDOW = WINDOW_SIZE_SECONDS * FRAMES_PER_SECOND
-PUPIL_MIN_SIZE_MM = 0
-PUPIL_MAX_SIZE_MM = 10
-INVALID_READING = 0
-GAZEPOINT_REFRESH = 60
-
-FIXATION_TARGETS = os.path.join(os.path.split(__file__)[0], "gaze_targets", "bear")
-IMAGE_OUTDIR = PupilWebcam.DEFAULT_OUTDIR
+PHOTO_WINDOW_SECONDS = 0.2 # photos use the sharpest frame from this long before the keypress
+STATUS_INTERVAL = 10 # seconds between status lines when headless
+METRICS_INTERVAL = 60 # seconds between pipeline stats lines
 
-RIGHT = 0
-LEFT = 1
-DELTA = 2
+LIGHT_KEYS = {'l': "on", 'd': "off"} # keys for noting when the light goes on and off
 
 def pressEnter(msg="Press enter to continue..."):
-    input(msg)
+    # nobody to press enter if we were started by a script or a service
+    if sys.stdin is not None and sys.stdin.isatty():
+        input(msg)
 
 class Pupillography:
-    def __init__(self, outpath):
+    def __init__(self, outpath, recordVideo=False, metricsPort=None, chunkBytes=None, chunkSeconds=None, channels=()):
         self.keepRunning = False
+        self.videoPath = (os.path.splitext(outpath)[0] + VIDEO_EXTENSION if recordVideo else None)
         self.targets = None
         self.webcam = None
-        self.eyedata = EyeData(outpath, GAZEPOINT_REFRESH)
-
-        # each x-coord has right, left, and delta values
-        # accessed as plotPupilData[y-set]
-        # similar for X and Y coords, but no delta
-        self.xData = [x / FRAMES_PER_SECOND for x in range(FRAMES_PER_WINDOW)]
-        self.plotPupilData = [[], [], []]
-        self.plotXData = [[], []]
-        self.plotYData = [[], []]
-        defaultYData = [INVALID_READING] * FRAMES_PER_WINDOW
-        for j in (RIGHT, LEFT, DELTA):
-            self.plotPupilData[j] = defaultYData.copy()
-
-        for j in (RIGHT, LEFT):
-            self.plotXData[j] = defaultYData.copy()
-            self.plotYData[j] = defaultYData.copy()
+        self.eyedata = EyeData(outpath, GAZEPOINT_REFRESH, channels=channels)
+        self.eyedata.chunkBytes = chunkBytes
+        self.eyedata.chunkSeconds = chunkSeconds
+        self.graph = None
+
+        # counters from each stage, logged every METRICS_INTERVAL and served
+        # at http://127.0.0.1:<metricsPort>/metrics if a port is given
+        self.metrics = Metrics()
+        self.metrics.add("eyedata", self.eyedata)
+        self.metricsPort = metricsPort
+
+        # links each photo to the eye tracking data
+        self.photoLogPath = os.path.splitext(outpath)[0] + "_photos.csv"
+        self.photoLog = None
+        self.photoRows = None # csv.writer for photoLog
+
+    def startMetrics(self):
+        self.metrics.startLogging(METRICS_INTERVAL)
+        if self.metricsPort is not None:
+            try:
+                self.metrics.serve(self.metricsPort)
+            except OSError as e:
+                print("ERROR: could not serve metrics on port", self.metricsPort, "-", e, file=sys.stderr)
+
+    def stopMetrics(self):
+        self.metrics.stop()
+        print("Stats:", self.metrics.statsLine())
 
     def onClose(self, event):
         self.stop()
 
     def detectKeys(self, key):
-        image_outpath = os.path.join(
-            IMAGE_OUTDIR,
-            datetime.now().strftime('%Y-%m-%d_%H-%M-%S') + "_" + self.targets.currentImageName())
+        pressed = monotonic()
+        name = getattr(key, 'name', None) # character keys don't have a name
+        char = getattr(key, 'char', None)
 
-        if key.name == 'space':
-            self.webcam.takePhoto(image_outpath)
-        elif key.name == 'left':
-            self.webcam.takePhoto(image_outpath)
+        # every keypress goes in the session file, as well as what it did
+        self.eyedata.addEvent("key", (name if name is not None else char), pressed)
+
+        if name == 'space':
+            self.takePhoto(pressed)
+        elif name == 'left':
+            self.takePhoto(pressed)
             self.targets.showPrevTarget()
-        elif key.name == 'right':
-            self.webcam.takePhoto(image_outpath)
+            self.eyedata.addEvent("target", self.targets.currentImageName())
+        elif name == 'right':
+            self.takePhoto(pressed)
             self.targets.showNextTarget()
-        elif key.name == 'esc':
+            self.eyedata.addEvent("target", self.targets.currentImageName())
+        elif name == 'esc':
             self.stop()
+        elif char is not None and char.lower() in LIGHT_KEYS:
+            self.eyedata.addEvent("light", LIGHT_KEYS[char.lower()], pressed)
+
+    def takePhoto(self, pressed):
+        # save the best frame from just before the key was pressed, and note
+        # where it is in the eye tracking data
+        target = self.targets.currentImageName()
+        image_outpath = os.path.join(
+            IMAGE_OUTDIR,
+            datetime.now().strftime('%Y-%m-%d_%H-%M-%S') + "_" + target)
+
+        capture_time = self.webcam.takePhotoBefore(pressed, PHOTO_WINDOW_SECONDS, image_outpath)
+        if capture_time is None:
+            return
+
+        elapsed = self.eyedata.elapsedAt(capture_time)
+        self.eyedata.addEvent("photo", image_outpath, capture_time)
+        self.photoRows.writerow([self.webcam.wallTime(capture_time).strftime('%Y-%m-%d_%H:%M:%S.%f'),
+                                 ("" if elapsed is None else elapsed), target, image_outpath])
+        self.photoLog.flush()
 
     def liveGraph(self):
         # wait until some data has been collected
         while not self.eyedata.dataAvailable():
             sleep(0.1)
 
-        # create three plots: pupils, x-pos, and y-pos
-        fig, axs = plt.subplots(3)
+        # the session file is open now, so note which target we started on
+        self.eyedata.addEvent("target", self.targets.currentImageName())
 
-        # plot config: exit on close window
-        fig.canvas.mpl_connect('close_event', self.onClose)
-        fig.canvas.manager.set_window_title("Pupil and X/Y Pos (close window to exit)")
+        # Tk is the most reliable backend alongside the OpenCV windows
+        import matplotlib
+        matplotlib.use('TkAgg')
+        from livegraph import LiveGraph
 
         self.keepRunning = True
-
-        # FIXME this is confusing
-        # line[0] has three plots: left, right, dela
-        # line[1] and line[2] only have left and right
-        line = [[[], [], []], [[], []], [[], []]] # this will store the plot line for live updating
-        currentLine = [[], [], []] # the vertical line showing the current time
-        while self.keepRunning:
-            xPos = int(self.eyedata.elapsed * FRAMES_PER_SECOND % FRAMES_PER_WINDOW)
-
-            # pupil data
-            for side, colour, label, diam in [(LEFT, "blue", "Left", self.eyedata.lpmm),
-                                              (RIGHT, "red", "Right", self.eyedata.rpmm),
-                                              (DELTA, "green", "Difference", self.eyedata.delta)]:
-                self.plotPupilData[side][xPos] = diam
-
-                if line[0][side] == []:
-                    axs[0].set_xlim([0, WINDOW_SIZE_SECONDS])
-                    axs[0].set_ylim([PUPIL_MIN_SIZE_MM, PUPIL_MAX_SIZE_MM])
-                    axs[0].set_title("Pupil size and X/Y position")
-                    axs[0].set(ylabel="Pupil (mm)")
-                    line[0][side], = axs[0].plot(self.xData, self.plotPupilData[side], c=colour, label=label)
-                else:
-                    line[0][side].set_ydata(self.plotPupilData[side])
-
-                # X/Y pos data
-                for side, colour, label, x, y in [(LEFT, "blue", "Left", self.eyedata.lpogx, self.eyedata.lpogy),
-                                                  (RIGHT, "red", "Right", self.eyedata.rpogx, self.eyedata.rpogy)]:
-                    self.plotXData[side][xPos] = x
-                    self.plotYData[side][xPos] = y
-
-                    for i, dat in ((1, self.plotXData[side]), (2, self.plotYData[side])):
-                        if line[i][side] == []:
-                            line[i][side], = axs[i].plot(self.xData, dat, c=colour, label=label)
-                        else:
-                            line[i][side].set_ydata(dat)
-
-                # add the "current time" line
-                current_xdata = [xPos / FRAMES_PER_SECOND, xPos / FRAMES_PER_SECOND]
-                current_ydata = [-0.5, PUPIL_MAX_SIZE_MM]
-                if currentLine[0] == []:
-                    for a in range(3):
-                        currentLine[a], = axs[a].plot(current_xdata, current_ydata, c="black", label="Current Time")
-
-                    # we only get here on the first run, so add in the other labels
-                    axs[1].set(ylabel="X-Pos")
-                    axs[2].set(xlabel="Time (moving window in seconds)", ylabel="Y-Pos")
-
-                    for a in (1, 2):
-                        axs[a].sharex(axs[0])
-                        axs[a].set_ylim([-0.5, 0.5])
-
-                    for a in range(3):
-                        axs[a].legend()
-
-                    fig.show()
-                else:
-                    for a in range(3):
-                        currentLine[a].set_xdata(current_xdata)
-                        currentLine[a].set_ydata(current_ydata)
-
-                fig.canvas.draw_idle()
-                fig.canvas.flush_events() # FIXME this is very slow
-
-                # self.detectKeys()
-
-            # end if pupilData is not None
-        # end while keepRunning
+        self.graph = LiveGraph(self.eyedata.samples, WINDOW_SIZE_SECONDS, FRAMES_PER_SECOND, GRAPH_REFRESH_RATE,
+                               (PUPIL_MIN_SIZE_MM, PUPIL_MAX_SIZE_MM), INVALID_READING, self.onClose, GAZEPOINT_REFRESH,
+                               self.eyedata.statusLine)
+        self.metrics.add("graph", self.graph)
+        self.graph.run()
+        print("Live graph:", self.graph.stats())
+        print("Pupils:", self.eyedata.statusLine())
 
     def run(self):
+        from dialogs import showMessage
+        from fixation import FixationTargets
+        from pynput import keyboard
+        from webcam import PupilWebcam
+
         # start the webcam preview
         self.webcam = PupilWebcam()
+        self.metrics.add("camera", self.webcam)
         self.webcam.startPreview()
-        ctypes.windll.user32.MessageBoxW(0, "Move the webcam preview window and press OK", "Window Position", 0)
+        showMessage("Window Position", "Move the webcam preview window and press OK")
 
         # show fixation targets
         self.targets = FixationTargets(FIXATION_TARGETS)
 
+        self.photoLog = open(self.photoLogPath, 'w', newline='')
+        self.photoRows = csv.writer(self.photoLog)
+        self.photoRows.writerow(["CaptureTime", "ElapsedTime", "Target", "Image"])
+
         # pull the data
-        data_thread = threading.Thread(target=self.eyedata.run)
+        self.startMetrics()
+        data_thread = threading.Thread(target=self.eyedata.runClient)
         data_thread.start()
 
+        if self.videoPath is not None:
+            self.webcam.startRecording(self.videoPath, self.eyedata.elapsedAt)
+
         # listen for keypresses
         listener = keyboard.Listener(on_press=self.detectKeys)
         listener.start()
@@ -181,40 +172,155 @@ class Pupillography:
         listener.join()
         self.eyedata.stop()
         data_thread.join()
+        self.webcam.stopRecording()
+        print("Camera:", self.webcam.stats())
         self.webcam.stopPreview()
+        self.webcam.waitForPhotos()
+        self.photoLog.close()
+        self.stopMetrics()
         pressEnter("Finished! Press enter to close the program")
         print("Goodbye")
 
+    def runHeadless(self, duration=None, waitForStart=False):
+        # Just the eye tracker and the session file, plus the camera if
+        # recording video: no windows, graph or keyboard hooks. Stops after
+        # duration seconds, on Ctrl+C or SIGTERM, or when enter is pressed.
+        # With waitForStart it doesn't start until SIGUSR1 or enter.
+        started = threading.Event()
+        stopped = threading.Event()
+
+        def onSignal(signum, frame):
+            if signum == getattr(signal, 'SIGUSR1', None):
+                started.set()
+            else:
+                stopped.set()
+                started.set()
+
+        for name in ('SIGINT', 'SIGTERM', 'SIGUSR1'):
+            if hasattr(signal, name):
+                signal.signal(getattr(signal, name), onSignal)
+
+        # enter starts (if waiting) and then stops
+        interactive = sys.stdin is not None and sys.stdin.isatty()
+        if interactive:
+            def waitForEnter():
+                if waitForStart:
+                    input()
+                    started.set()
+                input()
+                stopped.set()
+            threading.Thread(target=waitForEnter, daemon=True).start()
+
+        if waitForStart:
+            print("Waiting to start (", ("press enter or " if interactive else ""), "send SIGUSR1 to process ", os.getpid(), ")", sep="")
+            # a timeout so Ctrl+C still gets through on Windows
+            while not started.wait(0.5):
+                pass
+            if stopped.is_set():
+                return
+
+        self.startMetrics()
+        data_thread = threading.Thread(target=self.eyedata.runClient)
+        data_thread.start()
+
+        if self.videoPath is not None:
+            from webcam import PupilWebcam
+            self.webcam = PupilWebcam()
+            self.metrics.add("camera", self.webcam)
+            self.webcam.startCapture()
+            self.webcam.startRecording(self.videoPath, self.eyedata.elapsedAt)
+
+        print("Recording" + ("" if duration is None else " for " + str(duration) + "s") +
+              (", press enter to stop" if interactive else ", send SIGTERM to stop"))
+        start = monotonic()
+        self.keepRunning = True
+        while self.keepRunning and data_thread.is_alive():
+            wait = (STATUS_INTERVAL if duration is None else min(STATUS_INTERVAL, start + duration - monotonic()))
+            if stopped.wait(max(wait, 0)) or (duration is not None and monotonic() >= start + duration):
+                break
+
+            if self.eyedata.dataAvailable():
+                print("Pupils:", self.eyedata.statusLine(), flush=True)
+
+        self.eyedata.stop()
+        data_thread.join()
+        if self.webcam is not None:
+            self.webcam.stopRecording()
+            self.webcam.stopCapture()
+            print("Camera:", self.webcam.stats())
+        print("Pupils:", self.eyedata.statusLine())
+        self.stopMetrics()
+
     def stop(self):
         self.keepRunning = False
+        if self.graph is not None:
+            self.graph.stop()
         self.eyedata.stop()
 
 if __name__ == '__main__':
     def printUsage():
-        print("Usage:", sys.argv[0], "--help | <outfile_csv=results/[timestamp]>")
+        print("Usage:", sys.argv[0], "--help | [--video] [--metrics PORT] [--chunk-minutes M] [--chunk-mb N] [--channels NAMES] [--headless [--duration SECONDS] [--wait]] <outfile_csv=results/[timestamp]>")
+        print("      ", "--video also records the camera to a video next to the outfile")
+        print("      ", "--chunk-minutes and --chunk-mb split the session into files of at most this long or big, listed in <outfile>" + MANIFEST_EXTENSION)
+        print("      ", "--channels records other Gazepoint channels as well, e.g. pupil_left,cursor, as extra columns")
+        print("      ", "--metrics serves pipeline counters at http://127.0.0.1:PORT/metrics")
+        print("      ", "--headless only records, with no windows, graph or keyboard hooks")
+        print("      ", "--duration stops a headless recording after this many seconds")
+        print("      ", "--wait doesn't start a headless recording until enter is pressed or SIGUSR1 is received")
 
     ### command line arguments ###
 
-    if not os.path.isdir(FIXATION_TARGETS):
+    args = sys.argv[1:]
+    recordVideo = ("--video" in args)
+    if recordVideo:
+        args.remove("--video")
+    headless = ("--headless" in args)
+    if headless:
+        args.remove("--headless")
+    waitForStart = ("--wait" in args)
+    if waitForStart:
+        args.remove("--wait")
+
+    def optionValue(name, convert):
+        # removes "--name value" from args and returns the converted value, or None
+        if name not in args:
+            return None
+
+        i = args.index(name)
+        try:
+            value = convert(args[i + 1])
+        except (IndexError, ValueError):
+            printUsage()
+            sys.exit(1)
+        del args[i:i + 2]
+        return value
+
+    duration = optionValue("--duration", float)
+    metricsPort = optionValue("--metrics", int)
+    chunkMinutes = optionValue("--chunk-minutes", float)
+    chunkMegabytes = optionValue("--chunk-mb", float)
+    channels = optionValue("--channels", parseChannels) or []
+
+    if not headless and not os.path.isdir(FIXATION_TARGETS):
         print("ERROR: fixation targets missing, should be at:", FIXATION_TARGETS, file=sys.stderr)
         sys.exit(1)
 
     # default output file name
-    outpath = os.path.join(os.path.join(os.path.split(sys.argv[0])[0], "results"),
+    outpath = os.path.join(RESULTS_DIR,
                            datetime.now().strftime('%Y-%m-%d_%H-%M-%S') + '.csv')
 
-    if len(sys.argv) > 1:
-        if sys.argv[1] == "--help":
+    if len(args) > 0:
+        if args[0] == "--help":
             printUsage()
             pressEnter("Press enter to close the program")
             sys.exit(1)
         else:
-            if os.path.exists(sys.argv[1]):
-                print("Outfile '", sys.argv[1], "' already exists, exiting", sep="", file=sys.stderr)
+            if os.path.exists(args[0]):
+                print("Outfile '", args[0], "' already exists, exiting", sep="", file=sys.stderr)
                 pressEnter("Press enter to close the program")
                 sys.exit(1)
 
-            outpath = sys.argv[1]
+            outpath = args[0]
 
     # make sure the output directory exists
     outdir = os.path.split(outpath)[0]
@@ -226,7 +332,12 @@ if __name__ == '__main__':
             pressEnter("Press enter to close the program")
             sys.exit(1)
 
-    pup = Pupillography(outpath)
-    pup.run()
+    pup = Pupillography(outpath, recordVideo, metricsPort,
+                        (None if chunkMegabytes is None else int(chunkMegabytes * 1e6)),
+                        (None if chunkMinutes is None else chunkMinutes * 60), channels)
+    if headless:
+        pup.runHeadless(duration, waitForStart)
+    else:
+        pup.run()
 
 # EOF
@@ -0,0 +1,91 @@
+# play a recorded session back as Gazepoint records
+
+import csv
+import os
+import time
+
+from gazepoint import RECORD_FORMAT
+from sessionwriter import BINARY_EXTENSION, readBinary
+
+def sessionSamples(path, chunkSize=4096):
+    # Yields (elapsed, lpogx, lpogy, lpogv, rpogx, rpogy, rpogv, lpmm, lpmmv, rpmm, rpmmv)
+    # from a session file written by EyeData, one row at a time so any length
+    # of recording can be replayed.
+    if os.path.splitext(path)[1].lower() == BINARY_EXTENSION:
+        samples = readBinary(path)
+        fields = ['elapsed', 'lpogx', 'lpogy', 'lpogv', 'rpogx', 'rpogy', 'rpogv', 'lpmm', 'lpmmv', 'rpmm', 'rpmmv']
+        for start in range(0, len(samples), chunkSize):
+            yield from samples[start:start + chunkSize][fields].tolist()
+        return
+
+    with open(path, newline='') as infile:
+        rows = csv.reader(infile)
+        next(rows) # header
+
+        for row in rows:
+            if row[0].startswith('#'):
+                continue # an event, see sessionindex.EVENT_PREFIX
+
+            # any other channels' columns come after these, and aren't replayed
+            (_, elapsed, rpmm, lpmm, _, rpmmv, lpmmv, rpogx, lpogx, rpogy, lpogy, rpogv, lpogv) = row[:13]
+            yield (float(elapsed), float(lpogx), float(lpogy), lpogv == "1", float(rpogx), float(rpogy), rpogv == "1",
+                   float(lpmm), lpmmv == "1", float(rpmm), rpmmv == "1")
+
+def toRecord(sample):
+    # undo the changes EyeData makes, so the record looks like it came from the Gazepoint
+    (elapsed, lpogx, lpogy, lpogv, rpogx, rpogy, rpogv, lpmm, lpmmv, rpmm, rpmmv) = sample
+    return RECORD_FORMAT.format(elapsed, lpogx + 0.5, 0.5 - lpogy, lpogv, rpogx + 0.5, 0.5 - rpogy, rpogv,
+                                lpmm, lpmmv, rpmm, rpmmv).encode()
+
+class SessionReplay:
+    # Sends a session at its original timing (speed 1), N times faster, or as
+    # fast as possible (speed None). Records that are due at the same time go
+    # out in one send.
+
+    MAX_BATCH = 256 # records per send
+
+    def __init__(self, path, speed=1.0):
+        self.path = path
+        self.speed = speed
+        self.recordsSent = 0
+        self.keepRunning = False
+
+    def run(self, send):
+        # send is called with the bytes to go out, e.g. a socket's sendall
+        self.keepRunning = True
+        pending = []
+        firstElapsed = None
+        start = time.perf_counter()
+
+        for sample in sessionSamples(self.path):
+            if not self.keepRunning:
+                break
+
+            if self.speed is not None:
+                if firstElapsed is None:
+                    firstElapsed = sample[0]
+
+                wait = start + (sample[0] - firstElapsed) / self.speed - time.perf_counter()
+                if wait > 0:
+                    # send what's already due before waiting for this one
+                    self.send(send, pending)
+                    pending = []
+                    time.sleep(wait)
+
+            pending.append(toRecord(sample))
+            if len(pending) >= self.MAX_BATCH:
+                self.send(send, pending)
+                pending = []
+
+        self.send(send, pending)
+        self.keepRunning = False
+
+    def send(self, send, records):
+        if len(records) > 0:
+            send(b''.join(records))
+            self.recordsSent += len(records)
+
+    def stop(self):
+        self.keepRunning = False
+
+# EOF
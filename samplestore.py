@@ -0,0 +1,125 @@
+# fixed-size ring buffer of eye tracking samples
+
+import numpy as np
+
+# one row per Gazepoint record. Positions are already centred on the screen and
+# invalid pupil sizes are set to INVALID_READING, same as in the output file.
+SAMPLE_FIELDS = [
+    ('recvtime', 'i8'), # host time.monotonic_ns() when the record was received
+    ('sampletime', 'i8'), # host time.monotonic_ns() when the sample was taken, from ClockSync
+    ('elapsed', 'f8'), # Gazepoint TIME, relative to the first record
+    ('lpogx', 'f8'),
+    ('lpogy', 'f8'),
+    ('lpogv', '?'),
+    ('rpogx', 'f8'),
+    ('rpogy', 'f8'),
+    ('rpogv', '?'),
+    ('lpmm', 'f8'),
+    ('lpmmv', '?'),
+    ('rpmm', 'f8'),
+    ('rpmmv', '?'),
+    ('delta', 'f8'),
+]
+
+def sampleDtype(extraFields=()):
+    # the samples with any other channels that are enabled (RecordSchema.extraFields)
+    # after the usual fields, as they are from the Gazepoint
+    return np.dtype(SAMPLE_FIELDS + list(extraFields))
+
+SAMPLE_DTYPE = sampleDtype()
+
+class SampleStore:
+    # Single writer, many readers. Every sample gets a sequence number (the
+    # number of samples written before it) and is stored twice, at slot i and
+    # slot i + size. That way any run of up to `capacity` samples is one
+    # contiguous slice of the array, so readers always get a view, never a copy.
+    #
+    # Readers can see the last `capacity` samples, but there are `headroom`
+    # more slots than that. The writer writes at most `headroom` samples before
+    # publishing them (bumping `count`), so it only ever overwrites samples
+    # nobody can see any more: a view never mixes fields from two samples, and
+    # stays valid until `headroom` more samples have been written after it was
+    # taken - copy it if you need to keep it longer than that.
+
+    def __init__(self, capacity, dtype=SAMPLE_DTYPE, headroom=None):
+        if capacity < 1:
+            raise ValueError("SampleStore capacity must be at least 1")
+
+        self.capacity = capacity # samples readers can see
+        self.headroom = (headroom if headroom is not None else max(1, capacity // 4))
+        self.size = capacity + self.headroom # slots in the ring
+        self.dtype = dtype
+        self.data = np.zeros(self.size * 2, dtype=dtype)
+        self.count = 0 # total samples written == sequence number of the next sample
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def append(self, sample):
+        # sample is a tuple (or np.void) in dtype order
+        i = self.count % self.size
+        self.data[i] = sample
+        self.data[i + self.size] = sample
+        self.count += 1
+
+    def extend(self, samples):
+        # samples is a structured array with our dtype. A batch bigger than the
+        # headroom goes in a piece at a time, each published once it's written.
+        for start in range(0, len(samples), self.headroom):
+            piece = samples[start:start + self.headroom]
+            n = len(piece)
+            i = self.count % self.size
+            first = min(n, self.size - i)
+
+            # primary and mirrored copies, wrapping around to the start
+            self.data[i:i + first] = piece[:first]
+            self.data[i + self.size:i + self.size + first] = piece[:first]
+            if first < n:
+                self.data[:n - first] = piece[first:]
+                self.data[self.size:self.size + n - first] = piece[first:]
+
+            self.count += n
+
+    def oldest(self):
+        # sequence number of the oldest sample still available
+        return max(0, self.count - self.capacity)
+
+    def window(self, start, end):
+        # view of samples with sequence numbers [start, end)
+        start = max(start, self.oldest())
+        end = min(end, self.count)
+        if end <= start:
+            return self.data[:0]
+
+        i = start % self.size
+        return self.data[i:i + end - start]
+
+    def since(self, seq):
+        # all samples from sequence number seq onwards, plus the sequence number
+        # to ask for next time. If the caller has fallen more than a buffer
+        # behind, the samples it missed are skipped: compare seq with oldest().
+        end = self.count
+        return self.window(seq, end), end
+
+    def last(self, n):
+        end = self.count
+        return self.window(end - n, end)
+
+    def lastSeconds(self, seconds):
+        # samples from the last `seconds` of Gazepoint time
+        samples = self.last(self.capacity)
+        if len(samples) == 0:
+            return samples
+
+        elapsed = samples['elapsed']
+        return samples[np.searchsorted(elapsed, elapsed[-1] - seconds, side='left'):]
+
+    def latest(self):
+        # the most recent sample, or None if we don't have one yet
+        samples = self.last(1)
+        if len(samples) == 0:
+            return None
+
+        return samples[0].copy()
+
+# EOF
@@ -0,0 +1,153 @@
+# event markers in a session, and a sidecar index for loading any part of it
+
+import csv
+import numpy as np
+import os
+import sys
+
+INDEX_EXTENSION = ".idx" # session.csv -> session.csv.idx, a CSV file
+INDEX_HEADER = ["Kind", "SystemTime", "ElapsedTime", "Sample", "Offset", "Detail"]
+INDEX_INTERVAL = 10.0 # seconds of elapsed time between index rows, so a seek reads at most this much extra
+INTERVAL = "interval" # the Kind of the rows that aren't events
+
+# In a CSV session an event is a line of its own, starting with '#' so that
+# anything reading the samples (np.loadtxt, pandas with comment='#') skips it:
+#   #EVENT,SystemTime,ElapsedTime,Kind,Detail
+EVENT_PREFIX = "#EVENT"
+
+def indexPath(sessionPath):
+    # keeps the session's extension, so session.bin and session.csv (from binaryToCsv) have one each
+    return sessionPath + INDEX_EXTENSION
+
+class Event:
+    # Something that happened during a session: the target changing, a photo,
+    # the light going on, a key being pressed... The kind says which, and the
+    # detail which target, which photo etc. hostNs is when, by time.monotonic_ns().
+    # Once written, sample is the number of samples before it in the session
+    # file and offset is where it is in the file, in bytes.
+
+    def __init__(self, kind, detail="", elapsed=None, hostNs=None):
+        self.kind = kind
+        self.detail = " ".join(str(detail).split()) # one line
+        self.elapsed = elapsed
+        self.hostNs = hostNs
+        self.systemTime = "" # as in the session file, filled in when written
+        self.sample = None
+        self.offset = None
+
+    def __repr__(self):
+        return "Event({!r}, {!r}, elapsed={})".format(self.kind, self.detail, self.elapsed)
+
+class IndexWriter:
+    # Written by a session's sink as it goes: a row for the first sample of
+    # every INDEX_INTERVAL seconds, and one for every event, each with its
+    # sample number and byte offset in the session file.
+
+    def __init__(self, sessionPath, interval=INDEX_INTERVAL):
+        self.path = indexPath(sessionPath)
+        self.interval = interval
+        self.lastInterval = -np.inf # number of the last interval with a row
+        self.file = open(self.path, 'w', newline='')
+        self.csv = csv.writer(self.file)
+        self.csv.writerow(INDEX_HEADER)
+
+    def boundaries(self, elapsed):
+        # positions in a batch's elapsed times of the samples that start a new interval
+        numbers = np.floor(np.asarray(elapsed) / self.interval)
+        highest = np.maximum.accumulate(np.concatenate(([self.lastInterval], numbers)))
+        starts = np.flatnonzero(highest[1:] > highest[:-1])
+        self.lastInterval = highest[-1]
+        return starts
+
+    def addInterval(self, elapsed, sample, offset):
+        self.csv.writerow([INTERVAL, "", elapsed, sample, offset, ""])
+
+    def addEvent(self, event):
+        self.csv.writerow([event.kind, event.systemTime, ("" if event.elapsed is None else event.elapsed),
+                           event.sample, event.offset, event.detail])
+
+    def flush(self):
+        self.file.flush()
+
+    def sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        self.file.close()
+
+class SessionIndex:
+    # Reads a session's index, to find events and the part of the file that
+    # covers any stretch of time without reading the rest of it. Raises
+    # OSError if the session doesn't have an index.
+
+    def __init__(self, sessionPath):
+        self.sessionPath = sessionPath
+        self.eventList = []
+        elapsed, samples, offsets = [], [], []
+
+        with open(indexPath(sessionPath), newline='') as infile:
+            rows = csv.reader(infile)
+            next(rows) # header
+            for kind, systemTime, elapsedText, sample, offset, detail in rows:
+                if kind == INTERVAL:
+                    elapsed.append(float(elapsedText))
+                    samples.append(int(sample))
+                    offsets.append(int(offset))
+                    continue
+
+                event = Event(kind, detail, (float(elapsedText) if elapsedText != "" else None))
+                event.systemTime = systemTime
+                event.sample = int(sample)
+                event.offset = int(offset)
+                self.eventList.append(event)
+
+        self.elapsed = np.array(elapsed, dtype=float)
+        self.samples = np.array(samples, dtype=np.int64)
+        self.offsets = np.array(offsets, dtype=np.int64)
+
+    def events(self, kind=None, detail=None):
+        return [event for event in self.eventList
+                if (kind is None or event.kind == kind) and (detail is None or event.detail == detail)]
+
+    def segments(self, kind):
+        # (event, start, end) for each event of this kind, lasting until the
+        # next one. end is None for the last, meaning the end of the session.
+        events = [event for event in self.events(kind) if event.elapsed is not None]
+        ends = [event.elapsed for event in events[1:]] + [None]
+        return [(event, event.elapsed, end) for event, end in zip(events, ends)]
+
+    def span(self, start, end=None):
+        # (first sample, end sample, first offset, end offset) of a part of the
+        # file holding every sample from start to end (elapsed seconds), and at
+        # most an interval either side. The ends are None for the end of the file.
+        # None if the index has no intervals yet.
+        if len(self.elapsed) == 0:
+            return None
+
+        i = max(0, np.searchsorted(self.elapsed, start, side='right') - 1)
+        j = (len(self.elapsed) if end is None else np.searchsorted(self.elapsed, end, side='left'))
+        if j < len(self.elapsed):
+            return int(self.samples[i]), int(self.samples[j]), int(self.offsets[i]), int(self.offsets[j])
+
+        return int(self.samples[i]), None, int(self.offsets[i]), None
+
+if __name__ == '__main__':
+    def printUsage():
+        print("Usage:", os.path.split(__file__)[1], "<session_file> [kind]")
+        print("      ", "lists the events in a session, or just those of one kind (e.g. target, photo, light)")
+
+    if len(sys.argv) < 2:
+        printUsage()
+        sys.exit(1)
+
+    try:
+        index = SessionIndex(sys.argv[1])
+    except OSError as e:
+        print("ERROR: no index for this session:", e, file=sys.stderr)
+        sys.exit(1)
+
+    for event in index.events(sys.argv[2] if len(sys.argv) > 2 else None):
+        print(event.systemTime, ("" if event.elapsed is None else "{:.3f}".format(event.elapsed)), event.kind, event.detail, sep=',')
+
+# EOF
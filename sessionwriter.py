@@ -0,0 +1,646 @@
+# write eye tracking sessions to disk on a background thread
+
+import csv
+from datetime import datetime
+import io
+import json
+import numpy as np
+import os
+import queue
+import sys
+import threading
+import time
+
+from clocksync import clockAnchor, wallMicroseconds
+from metrics import Histogram
+from samplestore import SAMPLE_DTYPE
+from sessionindex import EVENT_PREFIX, IndexWriter, SessionIndex, indexPath
+
+CSV_HEADER = "SystemTime,ElapsedTime,Right Pupil,Left Pupil,Difference,Right Pupil Valid,Left Pupil Valid,Right X,Left X,Right Y,Left Y,Right Pos Valid,Left Pos Valid"
+
+# binary sessions are a small JSON header followed by fixed width records
+BINARY_EXTENSION = ".bin"
+BINARY_MAGIC = b'PUPLSESS'
+BINARY_VERSION = 2 # 2 has monotonic times and a clock anchor, instead of wall clock times
+BINARY_ALIGN = 64 # records start on this boundary so the file can be memory mapped
+
+# the sample fields that go in the CSV after SystemTime, in the order csvLines unpacks them
+CSV_FIELDS = ['elapsed', 'lpogx', 'lpogy', 'lpogv', 'rpogx', 'rpogy', 'rpogv', 'lpmm', 'lpmmv', 'rpmm', 'rpmmv', 'delta']
+
+# the columns of a CSV session after SystemTime, in the order they are in the file, and
+# what readCsv returns them as
+CSV_COLUMNS = ['elapsed', 'rpmm', 'lpmm', 'delta', 'rpmmv', 'lpmmv', 'rpogx', 'lpogx', 'rpogy', 'lpogy', 'rpogv', 'lpogv']
+CSV_DTYPE = np.dtype([(name, 'f8') for name in CSV_COLUMNS])
+
+# Samples with other Gazepoint channels enabled (see sampleDtype) have their
+# fields after 'delta'. They go after the usual columns in a CSV session, each
+# headed with its attribute name (lpcx -> LPCX), and in the dtype of a binary one.
+def extraFields(dtype):
+    return list(dtype.names[dtype.names.index('delta') + 1:])
+
+def csvHeader(dtype=SAMPLE_DTYPE):
+    return ",".join([CSV_HEADER] + [name.upper() for name in extraFields(dtype)])
+
+# a long session can be split into chunks, session_0001.csv, session_0002.csv
+# and so on, listed in session.csv.manifest.json (see ChunkedSink)
+MANIFEST_EXTENSION = ".manifest.json"
+MANIFEST_VERSION = 1
+
+def csvLines(batch, anchor):
+    # Returns the CSV lines for a batch of samples, in the same layout as
+    # always. SystemTime is when the sample was taken, turned into wall clock
+    # time with the anchor from clockAnchor(). Only the date and seconds go
+    # through strftime, once per second.
+    if 'sampletime' in batch.dtype.names:
+        micros = wallMicroseconds(batch['sampletime'], anchor)
+    else:
+        micros = np.round(batch['systime'] * 1e6).astype(np.int64) # version 1 binary files
+    seconds, micros = np.divmod(micros, 1000000)
+
+    lines = []
+    formatted = {}
+    for second, micro, (elapsed, lpogx, lpogy, lpogv, rpogx, rpogy, rpogv, lpmm, lpmmv, rpmm, rpmmv, delta) in \
+            zip(seconds.tolist(), micros.tolist(), batch[CSV_FIELDS].tolist()):
+        prefix = formatted.get(second)
+        if prefix is None:
+            prefix = datetime.fromtimestamp(second).strftime('%Y-%m-%d_%H:%M:%S')
+            formatted[second] = prefix
+
+        lines.append(f"{prefix}.{micro:06d},{elapsed},{rpmm},{lpmm},{delta},{int(rpmmv)},{int(lpmmv)},"
+                     f"{rpogx},{lpogx},{rpogy},{lpogy},{int(rpogv)},{int(lpogv)}\n")
+
+    extras = extraFields(batch.dtype)
+    if len(extras) > 0:
+        # valid flags as 0 and 1, like the usual ones
+        columns = [(batch[name].astype(np.int64) if batch.dtype[name] == np.bool_ else batch[name]).tolist() for name in extras]
+        lines = [line[:-1] + "," + ",".join(map(str, values)) + "\n" for line, values in zip(lines, zip(*columns))]
+
+    return lines
+
+def eventTime(event, anchor):
+    # an event's SystemTime, in the same format as the samples'
+    if event.hostNs is None:
+        return event.systemTime
+
+    second, micro = divmod(int(wallMicroseconds(event.hostNs, anchor)), 1000000)
+    return datetime.fromtimestamp(second).strftime('%Y-%m-%d_%H:%M:%S') + f".{micro:06d}"
+
+class CsvSink:
+    # Events are written in between the samples (see EVENT_PREFIX). The
+    # index needs byte offsets, so this keeps count of the bytes written.
+
+    def __init__(self, path, anchor=None, index=True, dtype=SAMPLE_DTYPE):
+        self.path = path
+        self.anchor = (anchor if anchor is not None else clockAnchor())
+        self.file = open(path, 'w')
+        header = csvHeader(dtype)
+        print(header, file=self.file)
+        self.newline = len(os.linesep) - 1 # extra bytes per line, on Windows
+        self.offset = len(header) + 1 + self.newline
+        self.samples = 0
+        self.index = (IndexWriter(path) if index else None)
+
+    def write(self, batch):
+        lines = csvLines(batch, self.anchor)
+        if self.index is not None:
+            for i in self.index.boundaries(batch['elapsed']):
+                offset = self.offset + sum(map(len, lines[:i])) + i * self.newline
+                self.index.addInterval(batch['elapsed'][i], self.samples + i, offset)
+
+        text = "".join(lines)
+        self.file.write(text)
+        self.offset += len(text) + len(lines) * self.newline
+        self.samples += len(batch)
+
+    def writeEvent(self, event):
+        event.systemTime = eventTime(event, self.anchor)
+        event.sample = self.samples
+        event.offset = self.offset
+        # as a CSV row, so a detail with a comma in it (e.g. the ',' key) is quoted
+        text = io.StringIO()
+        csv.writer(text, lineterminator="\n").writerow([EVENT_PREFIX, event.systemTime,
+                                                        ("" if event.elapsed is None else str(event.elapsed)),
+                                                        event.kind, event.detail])
+        line = text.getvalue()
+        self.file.write(line)
+        self.offset += len(line.encode(self.file.encoding)) + self.newline
+        if self.index is not None:
+            self.index.addEvent(event)
+
+    def flush(self):
+        self.file.flush()
+        if self.index is not None:
+            self.index.flush()
+
+    def sync(self):
+        # flush, and wait until it's on the disk rather than in the OS's cache
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        if self.index is not None:
+            self.index.sync()
+
+    def close(self):
+        self.file.close()
+        if self.index is not None:
+            self.index.close()
+
+class BinarySink:
+    # Records are fixed width so the file can be memory mapped, which leaves
+    # nowhere to put events in it: they only go in the index.
+
+    def __init__(self, path, dtype=SAMPLE_DTYPE, anchor=None, index=True):
+        self.path = path
+        self.dtype = dtype
+        self.anchor = (anchor if anchor is not None else clockAnchor())
+        self.file = open(path, 'wb')
+        header = binaryHeader(dtype, self.anchor)
+        self.file.write(header)
+        self.offset = len(header)
+        self.samples = 0
+        self.index = (IndexWriter(path) if index else None)
+
+    def write(self, batch):
+        if self.index is not None:
+            for i in self.index.boundaries(batch['elapsed']):
+                self.index.addInterval(batch['elapsed'][i], self.samples + i, self.offset + i * self.dtype.itemsize)
+
+        self.file.write(np.ascontiguousarray(batch, dtype=self.dtype).tobytes())
+        self.offset += len(batch) * self.dtype.itemsize
+        self.samples += len(batch)
+
+    def writeEvent(self, event):
+        event.systemTime = eventTime(event, self.anchor)
+        event.sample = self.samples
+        event.offset = self.offset
+        if self.index is not None:
+            self.index.addEvent(event)
+
+    def flush(self):
+        self.file.flush()
+        if self.index is not None:
+            self.index.flush()
+
+    def sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        if self.index is not None:
+            self.index.sync()
+
+    def close(self):
+        self.file.close()
+        if self.index is not None:
+            self.index.close()
+
+def binaryHeader(dtype, anchor):
+    info = json.dumps({"version": BINARY_VERSION,
+                       "dtype": dtype.descr,
+                       "created": datetime.now().isoformat(),
+                       "clock": anchor}).encode()
+
+    # magic, header length, JSON, then pad to the alignment boundary
+    length = len(BINARY_MAGIC) + 4 + len(info)
+    padding = -length % BINARY_ALIGN
+    return BINARY_MAGIC + (len(info) + padding).to_bytes(4, 'little') + info + b' ' * padding
+
+def readBinaryHeader(path):
+    # returns (header info, offset of the first record)
+    with open(path, 'rb') as infile:
+        if infile.read(len(BINARY_MAGIC)) != BINARY_MAGIC:
+            raise ValueError("Not a binary session file: " + path)
+
+        length = int.from_bytes(infile.read(4), 'little')
+        text = infile.read(length)
+
+    # e.g. a chunk started just before a crash
+    if length == 0 or len(text) < length:
+        raise ValueError("Incomplete binary session header: " + path)
+    info = json.loads(text)
+
+    if info["version"] not in (1, BINARY_VERSION):
+        raise ValueError("Unsupported binary session version: " + str(info["version"]))
+
+    info["dtype"] = np.dtype([tuple(field) for field in info["dtype"]])
+    return info, len(BINARY_MAGIC) + 4 + length
+
+def readBinary(path):
+    # memory maps a binary session; nothing is read until it is used
+    info, offset = readBinaryHeader(path)
+    count = (os.path.getsize(path) - offset) // info["dtype"].itemsize
+    if count == 0:
+        return np.zeros(0, dtype=info["dtype"])
+
+    return np.memmap(path, dtype=info["dtype"], mode='r', offset=offset, shape=(count,))
+
+def readCsv(path):
+    # a CSV session as an array of CSV_DTYPE, plus a column for each extra
+    # channel it has. A last line that was only partly written, e.g. if the
+    # recording crashed, is left out, and a file without a whole header has
+    # no samples.
+    with open(path, 'rb') as infile:
+        text = infile.read()
+
+    lines = text[:text.rfind(b'\n') + 1].decode().splitlines()
+    if len(lines) == 0:
+        return np.zeros(0, dtype=CSV_DTYPE)
+    columns = CSV_COLUMNS + [name.lower() for name in lines[0].split(',')[len(CSV_HEADER.split(',')):]]
+    dtype = np.dtype([(name, 'f8') for name in columns])
+    lines = lines[1:] # after the header
+    samples = np.zeros(0, dtype=dtype)
+    if any(not line.startswith('#') for line in lines):
+        # event lines start with '#', so loadtxt skips them
+        data = np.loadtxt(lines, delimiter=',', usecols=range(1, len(columns) + 1), ndmin=2)
+        samples = np.zeros(len(data), dtype=dtype)
+        for i, name in enumerate(columns):
+            samples[name] = data[:, i]
+
+    return samples
+
+def binaryToCsv(inpath, outpath, chunkSize=65536):
+    # the events from the binary session's index go back in between the samples
+    info, offset = readBinaryHeader(inpath)
+    samples = readBinary(inpath)
+    events = (SessionIndex(inpath).events() if os.path.exists(indexPath(inpath)) else [])
+    sink = CsvSink(outpath, info.get("clock"), dtype=info["dtype"])
+
+    start = 0
+    for event in events + [None]:
+        end = (len(samples) if event is None else min(event.sample, len(samples)))
+        for chunk in range(start, end, chunkSize):
+            sink.write(samples[chunk:min(chunk + chunkSize, end)])
+        start = max(start, end)
+        if event is not None:
+            sink.writeEvent(event)
+    sink.close()
+
+def openSink(path, anchor=None, maxBytes=None, maxSeconds=None, dtype=SAMPLE_DTYPE):
+    # the file extension picks the format. With either limit, the session is
+    # split into chunks no bigger or longer than that. dtype is the samples',
+    # which has more fields when more Gazepoint channels are enabled.
+    if maxBytes is not None or maxSeconds is not None:
+        return ChunkedSink(path, anchor, maxBytes, maxSeconds, dtype)
+
+    if os.path.splitext(path)[1].lower() == BINARY_EXTENSION:
+        return BinarySink(path, dtype, anchor)
+
+    return CsvSink(path, anchor, dtype=dtype)
+
+def manifestPath(sessionPath):
+    return sessionPath + MANIFEST_EXTENSION
+
+def chunkPath(sessionPath, number):
+    base, extension = os.path.splitext(sessionPath)
+    return f"{base}_{number:04d}{extension}"
+
+class ChunkedSink:
+    # Writes a session as a series of complete session files (chunks), each
+    # with its own index, starting a new one once the current one has
+    # maxBytes in it or covers maxSeconds of elapsed time. The manifest lists
+    # the chunks and is replaced in one go whenever a chunk starts or finishes
+    # and on every sync, so after a crash it still says where everything is
+    # and the chunks before the last are whole. ChunkedSession reads them back.
+
+    def __init__(self, path, anchor=None, maxBytes=None, maxSeconds=None, dtype=SAMPLE_DTYPE):
+        self.path = path
+        self.manifestPath = manifestPath(path)
+        self.anchor = (anchor if anchor is not None else clockAnchor())
+        self.dtype = dtype
+        self.maxBytes = maxBytes
+        self.maxSeconds = maxSeconds
+        self.created = datetime.now().isoformat()
+        self.chunks = [] # the manifest entries
+        self.samples = 0
+        self.sink = None
+        self.startChunk()
+
+    def startChunk(self):
+        path = chunkPath(self.path, len(self.chunks) + 1)
+        self.sink = openSink(path, self.anchor, dtype=self.dtype)
+        self.sink.sync() # so a chunk in the manifest always has its header
+        self.chunks.append({"path": os.path.split(path)[1], "firstSample": self.samples, "samples": 0,
+                            "start": None, "end": None, "bytes": 0, "complete": False})
+        self.writeManifest(False)
+
+    def finishChunk(self):
+        self.sink.sync()
+        self.sink.close()
+        self.chunks[-1].update(bytes=self.sink.offset, complete=True)
+
+    def write(self, batch):
+        while len(batch) > 0:
+            chunk = self.chunks[-1]
+            if chunk["start"] is None:
+                chunk["start"] = float(batch['elapsed'][0])
+
+            # how much of the batch fits in this chunk
+            n = len(batch)
+            if self.maxSeconds is not None:
+                n = int(np.searchsorted(batch['elapsed'], chunk["start"] + self.maxSeconds, side='left'))
+            full = (n == 0 or (self.maxBytes is not None and self.sink.offset >= self.maxBytes))
+            if full and self.sink.samples > 0:
+                self.finishChunk()
+                self.startChunk()
+                continue
+
+            n = max(n, 1)
+            self.sink.write(batch[:n])
+            self.samples += n
+            chunk.update(samples=self.sink.samples, end=float(batch['elapsed'][n - 1]), bytes=self.sink.offset)
+            batch = batch[n:]
+
+    def writeEvent(self, event):
+        self.sink.writeEvent(event)
+
+    def writeManifest(self, complete):
+        info = {"version": MANIFEST_VERSION,
+                "created": self.created,
+                "clock": self.anchor,
+                "maxBytes": self.maxBytes,
+                "maxSeconds": self.maxSeconds,
+                "samples": self.samples,
+                "complete": complete,
+                "chunks": self.chunks}
+
+        # write it alongside, then swap it in, so there's always a whole manifest
+        temppath = self.manifestPath + ".tmp"
+        with open(temppath, 'w') as outfile:
+            json.dump(info, outfile, indent=1)
+            outfile.flush()
+            os.fsync(outfile.fileno())
+        os.replace(temppath, self.manifestPath)
+
+    def flush(self):
+        self.sink.flush()
+
+    def sync(self):
+        self.sink.sync()
+        self.writeManifest(False)
+
+    def close(self):
+        self.finishChunk()
+        self.writeManifest(True)
+
+class ChunkedSession:
+    # The chunks of a session (see ChunkedSink) as one sequence of samples, or
+    # a single session file as a session of one chunk. Binary chunks are
+    # memory mapped and CSV chunks read when first used, with only the last
+    # CACHE_CHUNKS kept, so going through a session a block at a time (see
+    # blocks() and between()) takes the same memory however long it is.
+    # A chunk that was never finished is read up to its last whole sample.
+
+    CACHE_CHUNKS = 2
+
+    def __init__(self, path):
+        self.path = path
+        self.cache = {} # chunk number -> samples, most recently used last
+        if path.endswith(MANIFEST_EXTENSION):
+            with open(path) as infile:
+                info = json.load(infile)
+            directory = os.path.split(path)[0]
+            chunks = [chunk for chunk in info["chunks"] if os.path.exists(os.path.join(directory, chunk["path"]))]
+            self.paths = [os.path.join(directory, chunk["path"]) for chunk in chunks]
+        else:
+            chunks = [{"complete": False}]
+            self.paths = [path]
+
+        # the manifest has the length and times of every finished chunk, so only the last needs looking at
+        self.complete = [chunk["complete"] for chunk in chunks]
+        self.counts = []
+        self.ranges = [] # (first elapsed, last elapsed) of each chunk
+        for i, chunk in enumerate(chunks):
+            if chunk["complete"]:
+                self.counts.append(chunk["samples"])
+                self.ranges.append((chunk["start"], chunk["end"]))
+            else:
+                samples = self.chunk(i)
+                self.counts.append(len(samples))
+                self.ranges.append((float(samples['elapsed'][0]), float(samples['elapsed'][-1])) if len(samples) > 0 else (None, None))
+        self.firstSamples = np.concatenate(([0], np.cumsum(self.counts, dtype=np.int64)))
+
+    def __len__(self):
+        return int(self.firstSamples[-1])
+
+    def chunk(self, i):
+        samples = self.cache.pop(i, None)
+        if samples is None:
+            with open(self.paths[i], 'rb') as infile:
+                binary = (infile.read(len(BINARY_MAGIC)) == BINARY_MAGIC or
+                          os.path.splitext(self.paths[i])[1].lower() == BINARY_EXTENSION)
+            try:
+                samples = (readBinary(self.paths[i]) if binary else readCsv(self.paths[i]))
+            except ValueError:
+                # an unfinished chunk can be cut off before the end of its header, so has no samples
+                if self.complete[i]:
+                    raise
+                samples = None
+            if samples is None or (i > 0 and len(samples) == 0):
+                # the same fields as the others, so they can go together
+                samples = (self.chunk(i - 1)[:0] if i > 0 else np.zeros(0, dtype=(SAMPLE_DTYPE if binary else CSV_DTYPE)))
+
+        self.cache[i] = samples
+        while len(self.cache) > self.CACHE_CHUNKS:
+            del self.cache[next(iter(self.cache))]
+        return samples
+
+    def __getitem__(self, key):
+        # samples [start:stop] of the whole session, as one array
+        if not isinstance(key, slice):
+            key = (key if key >= 0 else len(self) + key)
+            if not 0 <= key < len(self):
+                raise IndexError("sample out of range")
+            i = int(np.searchsorted(self.firstSamples, key, side='right') - 1)
+            return self.chunk(i)[key - self.firstSamples[i]]
+
+        start, stop, step = key.indices(len(self))
+        if step != 1:
+            raise ValueError("ChunkedSession slices can't have a step")
+
+        pieces = []
+        for i in range(len(self.paths)):
+            first, end = self.firstSamples[i], self.firstSamples[i + 1]
+            if end > start and first < stop:
+                pieces.append(self.chunk(i)[max(start, first) - first:min(stop, end) - first])
+        if len(pieces) == 0:
+            return self.chunk(0)[:0]
+        return (pieces[0] if len(pieces) == 1 else np.concatenate(pieces))
+
+    def blocks(self, size):
+        # the whole session, size samples at a time
+        for start in range(0, len(self), size):
+            yield self[start:start + size]
+
+    def timeRange(self):
+        # (first elapsed, last elapsed), or None if there are no samples
+        ranges = [bounds for bounds in self.ranges if bounds[0] is not None]
+        if len(ranges) == 0:
+            return None
+        return ranges[0][0], ranges[-1][1]
+
+    def between(self, start, end):
+        # the samples from start to end, in elapsed seconds, as one array
+        pieces = []
+        for i, (first, last) in enumerate(self.ranges):
+            if first is None or last < start or first >= end:
+                continue
+            samples = self.chunk(i)
+            elapsed = samples['elapsed']
+            pieces.append(samples[np.searchsorted(elapsed, start, side='left'):np.searchsorted(elapsed, end, side='left')])
+        if len(pieces) == 0:
+            return self.chunk(0)[:0]
+        return (pieces[0] if len(pieces) == 1 else np.concatenate(pieces))
+
+    def events(self, kind=None, detail=None):
+        # the events from every chunk's index, numbered by sample in the whole session
+        events = []
+        for i, path in enumerate(self.paths):
+            if not os.path.exists(indexPath(path)):
+                continue
+            for event in SessionIndex(path).events(kind, detail):
+                event.sample += int(self.firstSamples[i])
+                events.append(event)
+        return events
+
+class SessionWriter:
+    # Takes batches of samples from the acquisition thread and writes them from
+    # its own thread, so formatting and disk I/O never hold up the socket. One
+    # writer can look after several sinks (e.g. one per eye tracker): pass the
+    # sink to write() and addSink() each one so it gets flushed and closed.
+    # Events (see sessionindex.Event) go through the same queue, so they end
+    # up in the file after the samples that came before them.
+
+    # Everything is flushed to the OS every flushInterval seconds, even while
+    # busy, so if the program dies no more than that is lost. Every
+    # syncInterval seconds it is also synced to the disk, so no more than that
+    # is lost if the computer does. None never syncs until the sinks are closed.
+
+    # Anything written after stop() is ignored, as the sinks are closed by then.
+
+    MAX_BATCHES = 64 # most batches to write in one go
+    FLUSH_INTERVAL = 1.0 # seconds between flushes to the OS
+    SYNC_INTERVAL = 10.0 # seconds between syncs to the disk
+
+    def __init__(self, sink=None, flushInterval=FLUSH_INTERVAL, syncInterval=SYNC_INTERVAL):
+        self.sink = sink # the default for write()
+        self.sinks = ([sink] if sink is not None else [])
+        self.flushInterval = flushInterval
+        self.syncInterval = syncInterval
+        self.queue = queue.Queue()
+        self.thread = None
+        self.stopped = False
+        self.samplesWritten = 0
+        self.latency = Histogram() # seconds from write() to the batch reaching the file
+        self.syncTime = Histogram() # seconds each sync took
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run)
+        self.thread.start()
+
+    def addSink(self, sink):
+        self.sinks.append(sink)
+
+    def write(self, batch, sink=None):
+        # batch must not change after this call - pass a copy of any view
+        if self.stopped:
+            return
+        self.queue.put((batch, time.perf_counter(), (sink if sink is not None else self.sink)))
+
+    def writeEvent(self, event, sink=None):
+        # safe to call from any thread
+        if self.stopped:
+            return
+        self.queue.put((event, time.perf_counter(), (sink if sink is not None else self.sink)))
+
+    def run(self):
+        keepRunning = True
+        lastFlush = lastSync = time.perf_counter()
+        while keepRunning:
+            try:
+                batches = [self.queue.get(timeout=self.flushInterval)]
+            except queue.Empty:
+                batches = []
+
+            # grab whatever else is waiting so it all goes out in one write
+            while len(batches) < self.MAX_BATCHES:
+                try:
+                    batches.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            # None means stop, once everything before it has been written;
+            # anything that raced in after it is dropped
+            if None in batches:
+                keepRunning = False
+                batches = batches[:batches.index(None)]
+
+            # as few writes per sink as the events allow, in the order they were queued
+            bySink = {}
+            for item, queued, sink in batches:
+                bySink.setdefault(sink, []).append(item)
+            for sink, items in bySink.items():
+                pending = []
+                for item in items:
+                    if isinstance(item, np.ndarray):
+                        pending.append(item)
+                        continue
+                    if len(pending) > 0:
+                        sink.write(np.concatenate(pending))
+                        pending = []
+                    sink.writeEvent(item)
+                if len(pending) > 0:
+                    sink.write(np.concatenate(pending))
+
+            written = time.perf_counter()
+            for item, queued, sink in batches:
+                if isinstance(item, np.ndarray):
+                    self.samplesWritten += len(item)
+                    self.latency.record(written - queued)
+
+            if self.syncInterval is not None and written - lastSync >= self.syncInterval:
+                for sink in self.sinks:
+                    sink.sync()
+                lastSync = lastFlush = time.perf_counter()
+                self.syncTime.record(lastSync - written)
+            elif written - lastFlush >= self.flushInterval:
+                for sink in self.sinks:
+                    sink.flush()
+                lastFlush = written
+
+        for sink in self.sinks:
+            sink.sync()
+            sink.close()
+
+    def metrics(self):
+        return {"samples": self.samplesWritten, "queued": self.queue.qsize(), "latency": self.latency.snapshot(),
+                "sync": self.syncTime.snapshot()}
+
+    def stats(self):
+        return "wrote {} samples, {} batches queued, latency {}".format(self.samplesWritten, self.queue.qsize(), self.latency.summary())
+
+    def stop(self):
+        if self.thread is None:
+            return
+
+        self.stopped = True
+        self.queue.put(None)
+        self.thread.join()
+        self.thread = None
+
+if __name__ == '__main__':
+    def printUsage():
+        print("Usage:", os.path.split(__file__)[1], "<session" + BINARY_EXTENSION + "> [outfile_csv]")
+        print("      ", "converts a binary session file to CSV")
+
+    if len(sys.argv) < 2:
+        printUsage()
+        sys.exit(1)
+
+    inpath = sys.argv[1]
+    outpath = (sys.argv[2] if len(sys.argv) > 2 else os.path.splitext(inpath)[0] + ".csv")
+
+    if os.path.exists(outpath):
+        print("Outfile '", outpath, "' already exists, exiting", sep="", file=sys.stderr)
+        sys.exit(1)
+
+    binaryToCsv(inpath, outpath)
+    print("Written to:", outpath)
+
+# EOF
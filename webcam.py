@@ -1,24 +1,223 @@
+from concurrent.futures import ThreadPoolExecutor
 import cv2
 from datetime import datetime
+import numpy as np
 import os
+import queue
 import sys
 import threading
+import time
 from time import sleep
 
+from constants import IMAGE_OUTDIR
+from metrics import Histogram, RateMeter
+
+class FrameRing:
+    # The last few camera frames, each with the time.monotonic() it was
+    # captured. The buffers are allocated once, when the first frame arrives,
+    # and the camera reads straight into them.
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.frames = None
+        self.times = np.full(capacity, -np.inf)
+        self.count = 0
+
+    def nextSlot(self):
+        # the buffer the next frame should be read into, or None if we don't know the frame size yet
+        if self.frames is None:
+            return None
+
+        # this slot is about to change, so stop anyone reading it
+        i = self.count % self.capacity
+        self.times[i] = -np.inf
+        return self.frames[i]
+
+    def store(self, frame, captureTime):
+        if self.frames is None or self.frames.shape[1:] != frame.shape:
+            self.frames = np.empty((self.capacity,) + frame.shape, dtype=frame.dtype)
+            self.times[:] = -np.inf
+            self.count = 0
+
+        i = self.count % self.capacity
+        if not np.shares_memory(frame, self.frames[i]):
+            np.copyto(self.frames[i], frame)
+        self.times[i] = captureTime
+        self.count += 1
+        return self.frames[i]
+
+    def nearest(self, t):
+        # copy of the frame captured closest to time t, and its capture time
+        if self.count == 0:
+            return None, None
+
+        i = np.argmin(np.abs(self.times - t))
+        return self.copyFrame(i)
+
+    def bestBefore(self, t, window):
+        # copy of the sharpest frame captured in the `window` seconds before
+        # time t, and its capture time. Falls back to the nearest frame.
+        candidates = np.flatnonzero((self.times <= t) & (self.times >= t - window))
+        if len(candidates) < 2:
+            return self.nearest(t)
+
+        scores = [sharpness(self.frames[i]) for i in candidates]
+        return self.copyFrame(candidates[np.argmax(scores)])
+
+    def copyFrame(self, i):
+        captureTime = self.times[i]
+        frame = self.frames[i].copy()
+
+        # make sure the camera didn't overwrite it while we were copying
+        if self.times[i] != captureTime or not np.isfinite(captureTime):
+            return None, None
+
+        return frame, captureTime
+
+def sharpness(frame):
+    # variance of the Laplacian, on a downscaled greyscale copy to keep it cheap
+    small = frame[::4, ::4]
+    if small.ndim == 3:
+        small = cv2.cvtColor(np.ascontiguousarray(small), cv2.COLOR_BGR2GRAY)
+    return cv2.Laplacian(small, cv2.CV_64F).var()
+
+class VideoRecorder:
+    # Records frames to a video file from its own thread. Frames are copied
+    # into a fixed set of buffers; if the encoder falls behind and they are all
+    # in use, new frames are dropped (and counted) rather than slowing down the
+    # camera. A CSV index next to the video gives each frame's capture time and
+    # the matching eye tracking elapsed time, see frameAtElapsed().
+
+    QUEUE_SIZE = 32 # frames waiting to be encoded
+    FOURCC = "mp4v"
+
+    def __init__(self, path, fps=30.0, elapsedAt=None, clockOffset=0.0):
+        self.path = path
+        self.index_path = os.path.splitext(path)[0] + "_index.csv"
+        self.fps = fps
+        self.elapsed_at = elapsedAt # maps a time.monotonic() time onto the eye tracking data
+        self.clock_offset = clockOffset # time.time() - time.monotonic()
+        self.buffers = None
+        self.free = queue.Queue()
+        self.waiting = queue.Queue()
+        self.thread = None
+        self.frames_written = 0
+        self.frames_dropped = 0
+
+    def add(self, frame, captureTime):
+        # called from the capture thread, never blocks
+        if self.buffers is None:
+            self.start(frame)
+
+        try:
+            i = self.free.get_nowait()
+        except queue.Empty:
+            self.frames_dropped += 1
+            return
+
+        np.copyto(self.buffers[i], frame)
+        self.waiting.put((i, captureTime))
+
+    def start(self, frame):
+        self.buffers = np.empty((self.QUEUE_SIZE,) + frame.shape, dtype=frame.dtype)
+        for i in range(self.QUEUE_SIZE):
+            self.free.put(i)
+
+        self.thread = threading.Thread(target=self.run, args=((frame.shape[1], frame.shape[0]),))
+        self.thread.start()
+
+    def run(self, frameSize):
+        writer = cv2.VideoWriter(self.path, cv2.VideoWriter_fourcc(*self.FOURCC), self.fps, frameSize)
+        with open(self.index_path, 'w') as index:
+            print("Frame,CaptureTime,ElapsedTime", file=index)
+
+            while True:
+                item = self.waiting.get()
+                if item is None:
+                    break
+
+                i, captureTime = item
+                writer.write(self.buffers[i])
+                self.free.put(i)
+
+                elapsed = (None if self.elapsed_at is None else self.elapsed_at(captureTime))
+                print(self.frames_written, datetime.fromtimestamp(captureTime + self.clock_offset).strftime('%Y-%m-%d_%H:%M:%S.%f'),
+                      ("" if elapsed is None else elapsed), sep=',', file=index)
+                self.frames_written += 1
+
+        writer.release()
+        print("Video saved to:", self.path, "(" + str(self.frames_written), "frames,", self.frames_dropped, "dropped)")
+
+    def metrics(self):
+        return {"framesWritten": self.frames_written, "framesDropped": self.frames_dropped, "queued": self.waiting.qsize()}
+
+    def stop(self):
+        # writes out any frames still waiting
+        if self.thread is not None:
+            self.waiting.put(None)
+            self.thread.join()
+            self.thread = None
+
+def frameAtElapsed(indexPath, elapsed):
+    # the frame number in a recording closest to an eye tracking elapsed time,
+    # e.g. for VideoCapture.set(cv2.CAP_PROP_POS_FRAMES, frame)
+    times = np.genfromtxt(indexPath, delimiter=',', skip_header=1, usecols=2)
+    times = np.atleast_1d(times)
+    valid = np.flatnonzero(~np.isnan(times))
+    if len(valid) == 0:
+        return None
+
+    return int(valid[np.argmin(np.abs(times[valid] - elapsed))])
+
 class PupilWebcam:
     vidcapture = None
     camera_index = 0
     frame = None
+    frame_time = None
     preview = False
+    preview_used = False # a preview window has been opened at some point
     preview_thread = None
+    capturing = False
+    capture_thread = None
+    photo_pool = None
+    recorder = None
 
     WINDOW_TITLE = "Camera Preview"
-    DEFAULT_OUTDIR = os.path.join(os.path.split(__file__)[0], "images")
+    DEFAULT_OUTDIR = IMAGE_OUTDIR
     IDEAL_CAMERA_RES = (1920, 1080)
     PREVIEW_WINDOW_RES = (960, 540)
+    PREVIEW_FPS = 15
+
+    # photos are saved in the background so taking one doesn't hold anything up
+    PHOTO_FORMATS = {"png": ".png", "jpg": ".jpg", "raw": ".npy"}
+    PHOTO_WORKERS = 2
+    MAX_PENDING_PHOTOS = 8 # each one is a full resolution frame held in memory
+
+    # recent frames, so a photo can be taken from just before a keypress
+    FRAME_RING_SIZE = 16 # about 100MB at 1920x1080
+
+    def __init__(self, cameraIndex=1, photoFormat="png", photoQuality=None, onPhotoSaved=None, previewFps=PREVIEW_FPS):
+        if photoFormat not in self.PHOTO_FORMATS:
+            raise ValueError("Unknown photo format: " + photoFormat)
 
-    def __init__(self, cameraIndex=1):
         self.camera_index = cameraIndex
+        self.preview_fps = previewFps
+        self.capture_rate = RateMeter()
+        self.display_rate = RateMeter()
+        self.photo_format = photoFormat
+        self.photo_quality = photoQuality # PNG compression level (0-9) or JPEG quality (0-100)
+        self.on_photo_saved = onPhotoSaved # called with (path, capture time, encode seconds)
+        self.pending_photos = threading.BoundedSemaphore(self.MAX_PENDING_PHOTOS)
+        self.photo_lock = threading.Lock() # for the counts, as several workers save photos
+        self.photos_taken = 0
+        self.photos_saved = 0
+        self.photos_failed = 0
+        self.encode_time = Histogram()
+        self.frames_captured = 0
+        self.frames = FrameRing(self.FRAME_RING_SIZE)
+
+        # for turning monotonic capture times into wall clock times
+        self.clock_offset = time.time() - time.monotonic()
         os.makedirs(self.DEFAULT_OUTDIR, exist_ok=True)
 
     def __del__(self):
@@ -26,21 +225,53 @@ class PupilWebcam:
             return
 
         self.stopPreview() # no-op if preview has stopped
+        self.stopRecording()
+        self.waitForPhotos()
         self.vidcapture.release()
-        cv2.destroyAllWindows()
+
+        # only if we opened one: OpenCV builds without GUI support (e.g.
+        # opencv-python-headless) raise here
+        if self.preview_used:
+            try:
+                cv2.destroyAllWindows()
+            except cv2.error:
+                pass
 
     def mouseClick(self, event, x, y, flags, param):
         if event == cv2.EVENT_LBUTTONUP:
             self.takePhoto()
 
-    def showFrame(self):
-        rv, self.frame = self.vidcapture.read()
+    def captureFrame(self):
+        # read the next frame from the camera, straight into the ring
+        slot = self.frames.nextSlot()
+        rv, frame = (self.vidcapture.read() if slot is None else self.vidcapture.read(slot))
+        captureTime = time.monotonic()
+
+        if not rv:
+            return False
+
+        self.frame = self.frames.store(frame, captureTime)
+        self.frame_time = captureTime
+        self.frames_captured += 1
+        self.capture_rate.tick()
+
+        recorder = self.recorder
+        if recorder is not None:
+            recorder.add(self.frame, captureTime)
+        return True
+
+    def captureLoop(self):
+        # runs as fast as the camera does, whatever the preview is doing
+        self.vidcapture = cv2.VideoCapture(self.camera_index)
+        self.vidcapture.set(cv2.CAP_PROP_FRAME_WIDTH, self.IDEAL_CAMERA_RES[0])
+        self.vidcapture.set(cv2.CAP_PROP_FRAME_HEIGHT, self.IDEAL_CAMERA_RES[1])
+
+        while self.capturing:
+            if not self.captureFrame():
+                print("ERROR: could not get camera frame", file=sys.stderr)
+                break
 
-        if rv:
-            cv2.imshow(self.WINDOW_TITLE, self.frame)
-            cv2.waitKey(10)
-        else:
-            raise ValueError("Could not get camera frame: " + str(rv))
+        self.capturing = False
 
     def previewLoop(self):
         # window setup
@@ -50,23 +281,57 @@ class PupilWebcam:
         # click the image to take a picture
         cv2.setMouseCallback(self.WINDOW_TITLE, self.mouseClick)
 
-        # start the stream
-        self.vidcapture = cv2.VideoCapture(self.camera_index)
-        self.vidcapture.set(cv2.CAP_PROP_FRAME_WIDTH, self.IDEAL_CAMERA_RES[0])
-        self.vidcapture.set(cv2.CAP_PROP_FRAME_HEIGHT, self.IDEAL_CAMERA_RES[1])
-        self.showFrame()
+        # the preview is drawn at its own rate, scaled down once to the window size
+        preview_frame = None
+        shown_time = None
+        period = 1.0 / self.preview_fps
+        while self.preview and self.capturing:
+            start = time.perf_counter()
+
+            frame = self.frame
+            if frame is not None and self.frame_time != shown_time:
+                shown_time = self.frame_time
+                if preview_frame is None or preview_frame.dtype != frame.dtype:
+                    preview_frame = np.empty((self.PREVIEW_WINDOW_RES[1], self.PREVIEW_WINDOW_RES[0]) + frame.shape[2:], dtype=frame.dtype)
+                cv2.resize(frame, self.PREVIEW_WINDOW_RES, dst=preview_frame, interpolation=cv2.INTER_AREA)
+                cv2.imshow(self.WINDOW_TITLE, preview_frame)
+                self.display_rate.tick()
 
-        while self.preview and cv2.getWindowProperty(self.WINDOW_TITLE, 0) >= 0:
-            self.showFrame()
+            wait = period - (time.perf_counter() - start)
+            cv2.waitKey(max(1, int(wait * 1000)))
+
+            # closing the window stops the camera
+            if shown_time is not None and cv2.getWindowProperty(self.WINDOW_TITLE, 0) < 0:
+                break
 
         self.preview = False
+        self.capturing = False
+
+    def startCapture(self):
+        # start the camera without a preview window
+        if self.capturing:
+            return
+
+        self.capturing = True
+        self.capture_thread = threading.Thread(target=self.captureLoop)
+        self.capture_thread.start()
+
+    def stopCapture(self):
+        if self.capture_thread is None:
+            return
+
+        self.capturing = False
+        self.capture_thread.join()
+        self.capture_thread = None
 
     def startPreview(self):
         print("Starting preview window...", end="", flush=True)
         if self.preview:
             return
 
+        self.startCapture()
         self.preview = True
+        self.preview_used = True
         self.preview_thread = threading.Thread(target=self.previewLoop)
         self.preview_thread.start()
         print("done")
@@ -79,18 +344,113 @@ class PupilWebcam:
         self.preview = False
         self.preview_thread.join()
         self.preview_thread = None
+        self.stopCapture()
         print("done")
 
-    def takePhoto(self, outfile=None):
+    def stats(self):
+        text = "camera {:.1f} fps, preview {:.1f} fps".format(self.capture_rate.rate, self.display_rate.rate)
+        if self.photos_taken > 0:
+            text += ", {} photos ({} waiting, {} failed), encode {}".format(
+                self.photos_taken, self.photos_taken - self.photos_saved - self.photos_failed, self.photos_failed,
+                self.encode_time.summary())
+        recorder = self.recorder
+        if recorder is not None:
+            text += ", video {} frames ({} dropped)".format(recorder.frames_written, recorder.frames_dropped)
+        return text
+
+    def metrics(self):
+        recorder = self.recorder
+        return {"captureFps": self.capture_rate.rate,
+                "displayFps": self.display_rate.rate,
+                "framesCaptured": self.frames_captured,
+                "photosTaken": self.photos_taken,
+                "photosWaiting": self.photos_taken - self.photos_saved - self.photos_failed,
+                "photosFailed": self.photos_failed,
+                "encodeTime": self.encode_time.snapshot(),
+                "recorder": (recorder.metrics() if recorder is not None else None)}
+
+    def startRecording(self, path, elapsedAt=None):
+        # record every frame to a video; elapsedAt maps capture times onto the eye tracking data
+        fps = (self.vidcapture.get(cv2.CAP_PROP_FPS) if self.vidcapture is not None else 0)
+        self.recorder = VideoRecorder(path, (fps if fps > 0 else 30.0), elapsedAt, self.clock_offset)
+        print("Recording video to:", path)
+
+    def stopRecording(self):
+        recorder = self.recorder
+        self.recorder = None
+        if recorder is not None:
+            recorder.stop()
+
+    def wallTime(self, monotonic):
+        return datetime.fromtimestamp(monotonic + self.clock_offset)
+
+    def takePhotoBefore(self, t, window, outfile=None):
+        # saves the sharpest frame from the `window` seconds before time.monotonic() t
+        frame, capture_time = self.frames.bestBefore(t, window)
+        return self.takePhoto(outfile, frame, capture_time)
+
+    def takePhoto(self, outfile=None, frame=None, capture_time=None):
+        # copies the frame (the current one by default) and returns straight
+        # away; the photo is saved by the worker pool. Returns the frame's
+        # time.monotonic() capture time, or None.
+        if frame is None:
+            frame = self.frame
+            capture_time = self.frame_time
+            if frame is not None:
+                frame = frame.copy()
+
+        if frame is None:
+            print("ERROR: cannot take photo (no frame loaded)", file=sys.stderr)
+            return None
+
+        if not self.pending_photos.acquire(blocking=False):
+            print("ERROR: too many photos waiting to be saved, photo skipped", file=sys.stderr)
+            return None
+
         if outfile is None:
             outfile = os.path.join(self.DEFAULT_OUTDIR,
-                                   datetime.now().strftime('%Y-%m-%d_%H-%M-%S') + ".png")
+                                   self.wallTime(capture_time).strftime('%Y-%m-%d_%H-%M-%S'))
+        outfile = os.path.splitext(outfile)[0] + self.PHOTO_FORMATS[self.photo_format]
 
-        if self.frame is not None:
-            cv2.imwrite(outfile, self.frame)
-            print("Image saved to:", outfile)
-        else:
-            print("ERROR: cannot take photo (no frame loaded)", file=sys.stderr)
+        with self.photo_lock:
+            self.photos_taken += 1
+        if self.photo_pool is None:
+            self.photo_pool = ThreadPoolExecutor(self.PHOTO_WORKERS, thread_name_prefix="photo")
+        self.photo_pool.submit(self.savePhoto, frame, outfile, capture_time)
+        return capture_time
+
+    def savePhoto(self, frame, outfile, capture_time):
+        try:
+            start = time.perf_counter()
+            if self.photo_format == "raw":
+                np.save(outfile, frame)
+            elif self.photo_format == "jpg":
+                cv2.imwrite(outfile, frame, [cv2.IMWRITE_JPEG_QUALITY, (95 if self.photo_quality is None else self.photo_quality)])
+            else:
+                cv2.imwrite(outfile, frame, [cv2.IMWRITE_PNG_COMPRESSION, (1 if self.photo_quality is None else self.photo_quality)])
+            encode_seconds = time.perf_counter() - start
+            with self.photo_lock:
+                self.encode_time.record(encode_seconds)
+
+            if self.on_photo_saved is not None:
+                self.on_photo_saved(outfile, capture_time, encode_seconds)
+            else:
+                print("Image saved to:", outfile, "(captured", self.wallTime(capture_time).strftime('%H:%M:%S.%f') + ",",
+                      "saved in", round(encode_seconds * 1000), "ms)")
+            with self.photo_lock:
+                self.photos_saved += 1
+        except Exception as e:
+            with self.photo_lock:
+                self.photos_failed += 1
+            print("ERROR: could not save photo", outfile + ":", e, file=sys.stderr)
+        finally:
+            self.pending_photos.release()
+
+    def waitForPhotos(self):
+        # blocks until every photo has been saved
+        if self.photo_pool is not None:
+            self.photo_pool.shutdown(wait=True)
+            self.photo_pool = None
 
 if __name__ == '__main__':
     # if running this script directly, use it as a webcam
@@ -101,6 +461,8 @@ if __name__ == '__main__':
     while webcam.preview:
         sleep(0.1)
 
+    print(webcam.stats())
     webcam.stopPreview()
+    webcam.waitForPhotos()
 
 # EOF